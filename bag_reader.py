@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import struct
+
+from typing import Dict
+
+# Reads the summary of a ROS bag v2.0 file without rosbag: the bag header record,
+# then the connection and chunk info records at the end of the file that make up the
+# index. Only those records are touched, through a memory map, so this takes about the
+# same time whatever the size of the bag.
+#
+# Every record is a uint32 header length, a header made of uint32 length prefixed
+# "name=value" fields, a uint32 data length and the data. The 'op' header field gives
+# the record type.
+
+magic = b'#ROSBAG V2.0\n'
+
+OP_BAG_HEADER = 0x03
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+uint32_struct = struct.Struct('<I')
+uint64_struct = struct.Struct('<Q')
+time_struct = struct.Struct('<2I')
+count_struct = struct.Struct('<2I')
+
+def read_fields(buffer, start: int, end: int) -> Dict[str, bytes]:
+  fields = {}
+  while start < end:
+    length, = uint32_struct.unpack_from(buffer, start)
+    start += 4
+    if start+length > end:
+      raise Exception('header field past end of record')
+    name, separator, value = bytes(buffer[start:start+length]).partition(b'=')
+    if not separator:
+      raise Exception('header field without name')
+    fields[name.decode()] = value
+    start += length
+  return fields
+
+def read_record(buffer, position: int):
+  # Returns the header fields, the start and end of the data, and where the next
+  # record begins.
+  if position+4 > len(buffer):
+    raise Exception('record header past end of file')
+  header_length, = uint32_struct.unpack_from(buffer, position)
+  header_end = position+4+header_length
+  if header_end+4 > len(buffer):
+    raise Exception('record header past end of file')
+  fields = read_fields(buffer, position+4, header_end)
+  data_length, = uint32_struct.unpack_from(buffer, header_end)
+  data_start = header_end+4
+  data_end = data_start+data_length
+  if data_end > len(buffer):
+    raise Exception('record data past end of file')
+  return fields, data_start, data_end, data_end
+
+def record_op(fields: Dict[str, bytes]) -> int:
+  if not 'op' in fields or len(fields['op']) != 1:
+    raise Exception('record without op')
+  return fields['op'][0]
+
+def read_time(value: bytes) -> float:
+  # Same conversion as rospy.Time.to_sec().
+  secs, nsecs = time_struct.unpack(value)
+  return float(secs)+float(nsecs)/1e9
+
+class BagInfo:
+  def __init__(self):
+    # index_pos is 0 while a bag is being recorded, and stays 0 when recording stops
+    # before the index gets written.
+    self.index_pos = 0
+    self.connection_count = 0
+    self.chunk_count = 0
+    # connection id: {'topic': ..., 'type': ..., 'md5sum': ...}
+    self.connections = {}
+    # {'start_time': ..., 'end_time': ..., 'counts': {connection id: message count}}
+    self.chunks = []
+
+  @property
+  def indexed(self) -> bool:
+    return self.index_pos != 0
+
+  def message_count(self) -> int:
+    return sum(sum(chunk['counts'].values()) for chunk in self.chunks)
+
+  def start_time(self) -> float:
+    if len(self.chunks) == 0:
+      return None
+    return min(chunk['start_time'] for chunk in self.chunks)
+
+  def end_time(self) -> float:
+    if len(self.chunks) == 0:
+      return None
+    return max(chunk['end_time'] for chunk in self.chunks)
+
+  def topic_types(self) -> Dict[str, str]:
+    return {c['topic']: c['type'] for c in self.connections.values()}
+
+def read_info(buffer) -> BagInfo:
+  if bytes(buffer[:len(magic)]) != magic:
+    raise Exception('not a ROS bag v2.0 file')
+  info = BagInfo()
+  fields, data_start, data_end, position = read_record(buffer, len(magic))
+  if record_op(fields) != OP_BAG_HEADER:
+    raise Exception('missing bag header record')
+  info.index_pos, = uint64_struct.unpack(fields['index_pos'])
+  info.connection_count, = uint32_struct.unpack(fields['conn_count'])
+  info.chunk_count, = uint32_struct.unpack(fields['chunk_count'])
+  if not info.indexed:
+    return info
+  if info.index_pos > len(buffer):
+    raise Exception('index position past end of file')
+
+  position = info.index_pos
+  for i in range(info.connection_count):
+    fields, data_start, data_end, position = read_record(buffer, position)
+    if record_op(fields) != OP_CONNECTION:
+      raise Exception('expected connection record')
+    connection, = uint32_struct.unpack(fields['conn'])
+    data = read_fields(buffer, data_start, data_end)
+    info.connections[connection] = {'topic': fields['topic'].decode(), 'type': data['type'].decode(), 'md5sum': data['md5sum'].decode()}
+  for i in range(info.chunk_count):
+    fields, data_start, data_end, position = read_record(buffer, position)
+    if record_op(fields) != OP_CHUNK_INFO:
+      raise Exception('expected chunk info record')
+    count, = uint32_struct.unpack(fields['count'])
+    if data_start+count*count_struct.size > data_end:
+      raise Exception('chunk info counts past end of record')
+    counts = {}
+    for c in range(count):
+      connection, message_count = count_struct.unpack_from(buffer, data_start+c*count_struct.size)
+      counts[connection] = message_count
+    info.chunks.append({'start_time': read_time(fields['start_time']), 'end_time': read_time(fields['end_time']), 'counts': counts})
+  return info
+
+# probe_bag results.
+INDEXED = 'indexed'
+UNINDEXED = 'unindexed'
+TRUNCATED = 'truncated'
+INVALID = 'invalid'
+
+probe_size = 4096
+
+def probe_bag(source) -> str:
+  # Classifies a bag from its first probe_size bytes and its size alone: the bag header
+  # record comes right after the magic, and its index_pos must land inside the file.
+  # source is a path or an open binary file.
+  if hasattr(source, 'fileno'):
+    return probe_file(source)
+  with open(source, 'rb') as infile:
+    return probe_file(infile)
+
+def probe_file(infile) -> str:
+  size = os.fstat(infile.fileno()).st_size
+  buffer = os.pread(infile.fileno(), probe_size, 0)
+  if len(buffer) < len(magic)+4:
+    return TRUNCATED if magic.startswith(buffer) else INVALID
+  if buffer[:len(magic)] != magic:
+    return INVALID
+  header_length, = uint32_struct.unpack_from(buffer, len(magic))
+  header_end = len(magic)+4+header_length
+  if header_end > len(buffer):
+    return TRUNCATED if header_end > size else INVALID
+  try:
+    fields = read_fields(buffer, len(magic)+4, header_end)
+    if record_op(fields) != OP_BAG_HEADER:
+      return INVALID
+    index_pos, = uint64_struct.unpack(fields['index_pos'])
+    connection_count, = uint32_struct.unpack(fields['conn_count'])
+    chunk_count, = uint32_struct.unpack(fields['chunk_count'])
+  except Exception:
+    return INVALID
+  if index_pos == 0:
+    return UNINDEXED
+  if index_pos > size or (index_pos == size and connection_count+chunk_count > 0):
+    return TRUNCATED
+  return INDEXED
+
+def read_bag_info(source) -> BagInfo:
+  # source is a path or an open binary file.
+  if hasattr(source, 'fileno'):
+    return read_file_info(source)
+  with open(source, 'rb') as infile:
+    return read_file_info(infile)
+
+def read_file_info(infile) -> BagInfo:
+  try:
+    buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+  except ValueError:
+    # Empty file.
+    raise Exception('not a ROS bag v2.0 file')
+  try:
+    return read_info(buffer)
+  except (struct.error, KeyError) as e:
+    raise Exception('malformed bag record: '+str(e))
+  finally:
+    buffer.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import bz2
+import fcntl
+import hashlib
+import mmap
+import os
+import pathlib
+
+import bag_reader
+from bag_reader import read_record, record_op, uint32_struct, uint64_struct, time_struct
+from odm_utils import atomic_write
+
+# Rebuilds the index of a ROS bag v2.0 file whose recording was cut short, without
+# rosbag. A first pass walks the record headers (and the records inside each chunk) to
+# find the connections and where each message is, without copying anything. The output
+# is then laid out as segments: the bag header rewritten with the final index position,
+# the complete chunks with their per connection index records, and the connection and
+# chunk info records that make up the index. A second pass writes those segments while
+# hashing them, so the output's sha256 is known without reading it back.
+#
+# When every segment taken from the source sits at the same offset in the output, the
+# source is cloned with the FICLONE ioctl (copy on write, on btrfs and xfs) and only the
+# rewritten header and the index are written.
+
+OP_MESSAGE_DATA = 0x02
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+
+FICLONE = 0x40049409
+copy_block_size = 8*1024*1024
+
+def field(name: str, value: bytes) -> bytes:
+  f = name.encode()+b'='+value
+  return uint32_struct.pack(len(f))+f
+
+def record(fields, data: bytes) -> bytes:
+  header = b''.join([field(name, value) for name, value in fields])
+  return uint32_struct.pack(len(header))+header+uint32_struct.pack(len(data))+data
+
+def decompress(compression: bytes, data) -> bytes:
+  if compression == b'none':
+    return data
+  if compression == b'bz2':
+    return bz2.decompress(data)
+  if compression == b'lz4':
+    try:
+      import roslz4
+      return roslz4.decompress(bytes(data))
+    except ImportError:
+      pass
+    try:
+      import lz4.frame
+      return lz4.frame.decompress(bytes(data))
+    except ImportError:
+      raise Exception('lz4 compressed chunk needs roslz4 or the lz4 package')
+  raise Exception('unknown chunk compression: '+compression.decode())
+
+class Chunk:
+  def __init__(self, position):
+    self.position = position
+    self.start_time = None
+    self.end_time = None
+    # Index entries per connection id, in the order connections first appear.
+    self.entries = {}
+
+  def read_records(self, data, start: int, end: int, connections) -> int:
+    # Walks the records of a chunk's data, returning where the last complete one ends.
+    # Offsets are relative to start, like the ones in index records.
+    position = start
+    while position < end:
+      try:
+        fields, data_start, data_end, next_position = read_record(data, position)
+      except Exception:
+        break
+      if next_position > end:
+        break
+      op = record_op(fields)
+      if op == bag_reader.OP_CONNECTION:
+        connection, = uint32_struct.unpack(fields['conn'])
+        if not connection in connections:
+          connections[connection] = (fields['topic'], bytes(data[data_start:data_end]))
+      elif op == OP_MESSAGE_DATA:
+        connection, = uint32_struct.unpack(fields['conn'])
+        time = time_struct.unpack(fields['time'])
+        if self.start_time is None or time < self.start_time:
+          self.start_time = time
+        if self.end_time is None or time > self.end_time:
+          self.end_time = time
+        if not connection in self.entries:
+          self.entries[connection] = []
+        self.entries[connection].append((fields['time'], position-start))
+      position = next_position
+    return position
+
+  def index_records(self) -> bytes:
+    ret = []
+    for connection, entries in self.entries.items():
+      data = b''.join([time+uint32_struct.pack(offset) for time, offset in entries])
+      ret.append(record([('op', bytes([OP_INDEX_DATA])), ('conn', uint32_struct.pack(connection)), ('ver', uint32_struct.pack(1)), ('count', uint32_struct.pack(len(entries)))], data))
+    return b''.join(ret)
+
+  def info_record(self, position: int) -> bytes:
+    data = b''.join([uint32_struct.pack(connection)+uint32_struct.pack(len(entries)) for connection, entries in self.entries.items()])
+    return record([('op', bytes([bag_reader.OP_CHUNK_INFO])), ('ver', uint32_struct.pack(1)), ('chunk_pos', uint64_struct.pack(position)), ('start_time', time_struct.pack(*self.start_time)), ('end_time', time_struct.pack(*self.end_time)), ('count', uint32_struct.pack(len(self.entries)))], data)
+
+def plan(buffer):
+  # Returns the output as a list of segments, (source start, source end) ranges or
+  # bytes, with the position of the bag header record in the list.
+  if bytes(buffer[:len(bag_reader.magic)]) != bag_reader.magic:
+    raise Exception('not a ROS bag v2.0 file')
+  fields, data_start, data_end, position = read_record(buffer, len(bag_reader.magic))
+  if record_op(fields) != bag_reader.OP_BAG_HEADER:
+    raise Exception('missing bag header record')
+  header_length = position-len(bag_reader.magic)
+
+  segments = [(0, len(bag_reader.magic)), None]
+  output_position = position
+  connections = {}
+  chunks = []
+  while position < len(buffer):
+    try:
+      fields, data_start, data_end, next_position = read_record(buffer, position)
+    except Exception:
+      break
+    op = record_op(fields)
+    if op == OP_INDEX_DATA:
+      # Index records of the last chunk, already accounted for.
+      position = next_position
+      continue
+    if op != OP_CHUNK:
+      # Start of an old index, or something unexpected; what follows is dropped.
+      break
+    chunk = Chunk(output_position)
+    size, = uint32_struct.unpack(fields['size'])
+    if size == 0 and data_end == data_start:
+      # A chunk still being written when recording stopped: its header has zero sizes
+      # and the uncompressed records follow it up to the end of the file.
+      if fields['compression'] != b'none':
+        break
+      end = chunk.read_records(buffer, data_start, len(buffer), connections)
+      if len(chunk.entries) == 0:
+        break
+      header = record([('op', bytes([OP_CHUNK])), ('compression', b'none'), ('size', uint32_struct.pack(end-data_start))], b'')
+      segments.append(header[:-4]+uint32_struct.pack(end-data_start))
+      segments.append((data_start, end))
+      output_position += len(header)+end-data_start
+      next_position = len(buffer)
+    else:
+      with memoryview(buffer)[data_start:data_end] as compressed:
+        data = decompress(fields['compression'], compressed)
+        chunk.read_records(data, 0, len(data), connections)
+        del data
+      if len(chunk.entries) == 0:
+        position = next_position
+        continue
+      segments.append((position, data_end))
+      output_position += data_end-position
+    chunks.append(chunk)
+    # Index records that match what the source has after the chunk are copied, so the
+    # layouts stay aligned.
+    index = chunk.index_records()
+    if bytes(buffer[next_position:next_position+len(index)]) == index:
+      segments.append((next_position, next_position+len(index)))
+    else:
+      segments.append(index)
+    output_position += len(index)
+    position = next_position
+
+  index_position = output_position
+  index = []
+  for connection, (topic, data) in connections.items():
+    index.append(record([('op', bytes([bag_reader.OP_CONNECTION])), ('topic', topic), ('conn', uint32_struct.pack(connection))], data))
+  for chunk in chunks:
+    index.append(chunk.info_record(chunk.position))
+  segments.append(b''.join(index))
+
+  # The bag header record keeps its length, padded with spaces as rosbag does.
+  header = b''.join([field('op', bytes([bag_reader.OP_BAG_HEADER])), field('index_pos', uint64_struct.pack(index_position)), field('conn_count', uint32_struct.pack(len(connections))), field('chunk_count', uint32_struct.pack(len(chunks)))])
+  padding = header_length-8-len(header)
+  if padding < 0:
+    raise Exception('bag header record too short')
+  segments[1] = uint32_struct.pack(len(header))+header+uint32_struct.pack(padding)+b' '*padding
+  return segments
+
+def aligned(segments) -> bool:
+  # True when every source range lands at its own offset in the output.
+  position = 0
+  for segment in segments:
+    if isinstance(segment, tuple):
+      if segment[0] != position:
+        return False
+      position = segment[1]
+    else:
+      position += len(segment)
+  return True
+
+def clone(source, destination) -> bool:
+  try:
+    fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+    return True
+  except OSError:
+    return False
+
+def reindex_bag(source, output_path: pathlib.Path) -> str:
+  # Writes an indexed copy of source to output_path and returns its sha256. source is
+  # a path or an open binary file.
+  if hasattr(source, 'fileno'):
+    return reindex_file(source, output_path)
+  with open(source, 'rb') as infile:
+    return reindex_file(infile, output_path)
+
+def reindex_file(source, output_path: pathlib.Path) -> str:
+  buffer = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    with memoryview(buffer) as view:
+      segments = plan(buffer)
+      hash = hashlib.sha256()
+      with atomic_write(output_path, 'wb') as output:
+        cloned = aligned(segments) and clone(source, output)
+        position = 0
+        for segment in segments:
+          if isinstance(segment, tuple):
+            for start in range(segment[0], segment[1], copy_block_size):
+              with view[start:min(start+copy_block_size, segment[1])] as block:
+                hash.update(block)
+                if not cloned:
+                  output.write(block)
+            position = segment[1]
+          else:
+            hash.update(segment)
+            if cloned:
+              os.pwrite(output.fileno(), segment, position)
+            else:
+              output.write(segment)
+            position += len(segment)
+        if cloned:
+          output.truncate(position)
+  finally:
+    buffer.close()
+  return hash.hexdigest()
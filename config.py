@@ -26,9 +26,9 @@ class ConfigPath:
     return ret
 
 
-  def create_project(self, label: str, source: pathlib.Path, output: pathlib.Path) -> Project:
+  def create_project(self, label: str, source: pathlib.Path, output: pathlib.Path, meta_backend: str = 'json') -> Project:
     p = Project(self.path/label)
-    p.create(source, output)
+    p.create(source, output, meta_backend)
     return p
 
   def get_project(self, label: str) -> Project:
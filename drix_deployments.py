@@ -1,21 +1,223 @@
 #!/usr/bin/env python3
 
 import json
-import odm_utils
-import rospy
 import datetime
 import pathlib
 import subprocess
 
+import odm_utils
+import track_store
+import nav_exporters
 from file_info import FileInfo
 from project import Project
+from interval_index import IntervalIndex
+from ros_bag_handler import RosBagHandler
+from scheduler import WorkScheduler
+
+from typing import List
+
+# Bump when the generated products change so existing ones get regenerated.
+products_version = 2
+
+def recording_source(f: FileInfo) -> str:
+  # Which bag recording source (drix mdt, robobox, project11, etc.) a file is from.
+  if 'ROBOBOX' in f.local_path.name:
+    return 'robobox'
+  elif 'VEHICLE' in f.local_path.name and f.local_path.parts[-2] == 'mission_logs':
+    return 'drix'
+  elif 'project11' in f.local_path.name:
+    if 'project11_operator' in f.local_path.name:
+      return 'p11_operator'
+    else:
+      return 'p11'
+  return None
+
+def output_vehicle(path: pathlib.Path) -> str:
+  # The vehicle a product file is for, from its name: <vehicle>_bounds.json or
+  # <vehicle>.<format>.
+  if path.name.endswith('_bounds.json'):
+    return path.name[:-len('_bounds.json')]
+  return path.name.split('.')[0]
+
+def deployment_settings(project: Project):
+  # The nav formats written, from the project config's 'nav_formats' list, and the
+  # exporters' settings. KML lines are simplified to within tolerance meters of the
+  # nav track.
+  settings = {'nav_formats': list(nav_exporters.default_formats), 'kml': {'tolerance': 1.0, 'max_points': 65536}}
+  if project.config is not None:
+    if 'nav_formats' in project.config:
+      settings['nav_formats'] = list(project.config['nav_formats'])
+    if 'kml' in project.config:
+      settings['kml'].update(project.config['kml'])
+  return settings
+
+def generateUnit(unit):
+  outputs = unit.generate()
+  return unit.key, outputs, unit.log
+
+class DeploymentUnit:
+  # The products of one recording source during one deployment: a bounds file and one
+  # file per configured nav format for each vehicle. Holds only what a worker process
+  # needs to write them.
+  def __init__(self, project: Project, key, deployment, sources, bag_tracks, start_time, end_time, output_path, inputs):
+    self.project = project
+    self.key = key
+    self.deployment = deployment
+    self.deployment_id = deployment['name']
+    self.sources = sources
+    self.bag_tracks = bag_tracks
+    self.start_time = start_time
+    self.end_time = end_time
+    self.output_path = output_path
+    self.inputs = inputs
+    self.log = []
+    self.settings = deployment_settings(project)
+
+  def fix_count(self):
+    count = 0
+    for meta in self.bag_tracks:
+      if 'track_files' in meta:
+        count += sum(r['count'] for r in meta['track_files'].values())
+      elif 'tracks' in meta:
+        count += sum(len(t) for t in meta['tracks'].values())
+    return count
+
+  def generate(self) -> List[pathlib.Path]:
+    # Returns the paths written.
+    outputs = []
+    bounds = {}
+    deployment_tracks = {}
+    self.log.append(self.key)
+    # For each bagfile.
+    for meta in self.bag_tracks:
+      # The RosBagHandler extracts the position data from each bag file into a track
+      # per vehicle, stored in track files referenced from the meta.
+      for vehicle, track in track_store.load_meta_tracks(self.project, meta).items():
+        if not vehicle in deployment_tracks:
+          deployment_tracks[vehicle] = []
+          bounds[vehicle] = None
+        # Bounds cover every fix in the deployment window. Clipping a track file
+        # leaves a view of it, read a block at a time when merging.
+        track = track_store.clip(track, self.start_time, self.end_time)
+        bounds[vehicle] = track_store.merge_bounds(bounds[vehicle], track_store.bounds(track))
+        deployment_tracks[vehicle].append(track)
+
+    for vehicle in deployment_tracks:
+      self.output_path.mkdir(parents=True, exist_ok=True)
+      # Write the navigation bounds file.
+      bounds_path = self.output_path/(vehicle+'_bounds.json')
+      self.log.append("Writing deployment spatial bounds: %s" % bounds_path)
+      bounds_file = bounds_path.open('w')
+      json.dump(bounds[vehicle] or {'min':{},'max':{}},bounds_file)
+      bounds_file.close()
+      outputs.append(bounds_path)
+      # Write the track in each configured format.
+      label = self.deployment_id+'_'+vehicle
+      style = {'Mothership':'mothership','DriX':'drix','Nautilus':'mothership','nui':'nui','Mesobot':'mesobot'}[vehicle]
+      writers = []
+      for nav_format in self.settings['nav_formats']:
+        if not nav_format in nav_exporters.exporters:
+          self.log.append("Unknown nav format: %s" % nav_format)
+          continue
+        writers.append((nav_format, nav_exporters.exporters[nav_format](self.output_path/vehicle, label, style, self.settings)))
+      # The per bag tracks are merged in time order with fixes at least a second
+      # apart. Because topics get duplicated between vehicle and operating station,
+      # duplicates are dropped while merging. The merged fixes go to the writers a
+      # block at a time.
+      count = 0
+      for block in track_store.fix_blocks(track_store.merge_tracks(deployment_tracks[vehicle], 1.0)):
+        count += block.shape[1]
+        for nav_format, writer in writers:
+          writer.update(block)
+      self.log.append('merged fixes: '+str(count))
+      for nav_format, writer in writers:
+        path = writer.finish()
+        self.log.append("Writing %s: %s" % (nav_format, path))
+        outputs.append(path)
+    return outputs
 
 class DrixDeployments:
-  def __init__(self, project: Project, verbose=0):
+  recording_sources = ('drix','robobox','p11','p11_operator')
+
+  def __init__(self, project: Project, verbose=0, process_count=1):
     self.project = project
     self.verbose = verbose
+    self.process_count = process_count
+    self.bag_indexes = None
+    self.state_file = project.config_path/'deployments_state.json'
+
+  def build_bag_indexes(self):
+    # One pass over the project: an IntervalIndex of bag time ranges for each
+    # platform and recording source.
+    intervals = {}
+    for f in self.project():
+      if len(f.local_path.parts) < 2 or f.meta is None:
+        continue
+      if 'RosBagHandler' in f.meta and 'start_time' in f.meta['RosBagHandler'] and 'end_time' in f.meta['RosBagHandler']:
+        source = recording_source(f)
+        if source is not None:
+          key = (f.local_path.parts[0], source)
+          if not key in intervals:
+            intervals[key] = []
+          intervals[key].append((f.meta['RosBagHandler']['start_time'], f.meta['RosBagHandler']['end_time'], f))
+    self.bag_indexes = {key: IntervalIndex(i) for key, i in intervals.items()}
+
+  def overlapping(self, platform: str, start_time: float, end_time: float, source: str = None) -> List[FileInfo]:
+    # Bags of a platform, optionally from one recording source, whose time range
+    # overlaps start_time to end_time (seconds since the epoch).
+    if self.bag_indexes is None:
+      self.build_bag_indexes()
+    ret = []
+    for s in self.recording_sources:
+      if source is None or s == source:
+        if (platform, s) in self.bag_indexes:
+          ret += self.bag_indexes[(platform, s)].overlapping(start_time, end_time)
+    return ret
+
+  def load_state(self):
+    if self.state_file.is_file():
+      try:
+        with self.state_file.open() as infile:
+          state = json.load(infile)
+        if state.get('version') == products_version:
+          return state['products']
+      except json.decoder.JSONDecodeError as e:
+        print('error loading deployment state:', self.state_file, e)
+    return {}
+
+  def save_state(self, products):
+    with odm_utils.atomic_write(self.state_file) as outfile:
+      json.dump({'version': products_version, 'products': products}, outfile)
 
-  def generate(self):
+  def input_signature(self, bagfiles: List[FileInfo]):
+    # Hash (when known) and modify time of each input bag.
+    inputs = {}
+    for f in bagfiles:
+      file_hash = None
+      if 'HashHandler' in f.meta:
+        file_hash = f.meta['HashHandler'].get('hash')
+      modify_time = None
+      if 'FileInfo' in f.meta:
+        modify_time = f.meta['FileInfo'].get('modify_time')
+      inputs[str(f.local_path)] = [file_hash, modify_time]
+    return inputs
+
+  def generate(self, force=False):
+    # Products of a deployment and recording source are only regenerated when their
+    # input bags, the deployment's entry in deployments.json, the nav formats and their
+    # settings or products_version changed since the last run, or one of the files they
+    # wrote is gone.
+    if len(self.project.files) == 0:
+      self.project.load()
+    self.build_bag_indexes()
+    settings = deployment_settings(self.project)
+    previous_state = self.load_state()
+    state = {} if force else previous_state
+    new_state = {}
+    # Keys of every product deployments.json still lists, regenerated or not.
+    configured = set()
+    units = []
+    worker_project = self.project.worker_copy()
     # Loops over possible platforms, drix08, plus others, in the top level archive directory.
     for platform in self.project.platforms():
       print("Platforms in project: ",platform)
@@ -31,103 +233,47 @@ class DrixDeployments:
         start_time = datetime.datetime.fromisoformat(d['begin']+'+00:00').timestamp()
         end_time = datetime.datetime.fromisoformat(d['end']+'+00:00').timestamp()
         print(start_time,'to',end_time)
-        bagfiles = {'drix':[],'robobox':[],'p11':[],'p11_operator':[]}
-        for f in self.project(pathlib.Path(platform)):
-          # if f.local_path.suffix == '.bag' and not 'RosBagHandler' in f.meta:
-          #   print('RosBagHandler not in meta for ',f.local_path)
-            # Find the logs from each source having timestamps within the bounds of the 
-            # deployment start and end time:
-          if 'RosBagHandler' in f.meta and 'start_time' in f.meta['RosBagHandler'] and 'end_time' in f.meta['RosBagHandler']:
-            f_start_time = f.meta['RosBagHandler']['start_time']
-            f_end_time = f.meta['RosBagHandler']['end_time']
-            if f_start_time < end_time and f_end_time > start_time:
-              #print('      ',f.local_path.name)
-              if 'ROBOBOX' in f.local_path.name:
-                bagfiles['robobox'].append(f)
-              elif 'VEHICLE' in f.local_path.name and f.local_path.parts[-2] == 'mission_logs':
-                bagfiles['drix'].append(f)
-              elif 'project11' in f.local_path.name:
-                if 'project11_operator' in f.local_path.name:
-                  bagfiles['p11_operator'].append(f)
-                else:
-                  bagfiles['p11'].append(f)
 
         # For each bag recording source (drix mdt, robobox, project11, etc.)
-        for sources in bagfiles:
-          print('  ',sources,len(bagfiles[sources]),'sources')
-          bounds = {}
-          deployment_tracks = {}
-          # For each bagfile.
-          for fi in bagfiles[sources]:
-            if fi.meta is not None and 'RosBagHandler' in fi.meta:
-              # The metadata consists a list of dictionaries. Each "handler" optionally creates
-              # metadata about the file, creating one of these dictionaries. This for loop
-              # seems like it is not required. 
-              for k in fi.meta['RosBagHandler']:
-                #print (' ',k)
-                # The RosBagHandler extracts the position data from each bag file, and stores this in the 
-                # meta data as a "tracks" dictionary keyed by the vehicle name.  
-                if 'tracks' in fi.meta['RosBagHandler']:
-                  # Then we loop through each vehicle track.
-                  for vehicle in fi.meta['RosBagHandler']['tracks']:
-                    
-                    if not vehicle in deployment_tracks:
-                      deployment_tracks[vehicle] = []
-                      bounds[vehicle] = {'min':{},'max':{}}
-                    last_time = None
-                    for position in fi.meta['RosBagHandler']['tracks'][vehicle]:
-                      if position['timestamp'] >= start_time and position['timestamp'] <= end_time:
-                        if last_time is None or position['timestamp'] >= last_time+1.0:
-                          deployment_tracks[vehicle].append(datetime.datetime.fromtimestamp(position['timestamp'], tz=datetime.timezone(datetime.timedelta(0.0))).isoformat()+','+str(position['timestamp'])+','+str(position['latitude'])+','+str(position['longitude'])+','+str(position['altitude']))
-                          last_time = position['timestamp']
-                        if 'latitude' in bounds[vehicle]['min']:
-                          bounds[vehicle]['min']['latitude'] = min(position['latitude'],bounds[vehicle]['min']['latitude'])
-                          bounds[vehicle]['min']['longitude'] = min(position['longitude'],bounds[vehicle]['min']['longitude'])
-                          bounds[vehicle]['min']['altitude'] = min(position['altitude'],bounds[vehicle]['min']['altitude'])
-                          bounds[vehicle]['max']['latitude'] = max(position['latitude'],bounds[vehicle]['max']['latitude'])
-                          bounds[vehicle]['max']['longitude'] = max(position['longitude'],bounds[vehicle]['max']['longitude'])
-                          bounds[vehicle]['max']['altitude'] = max(position['altitude'],bounds[vehicle]['max']['altitude'])
-                        else:
-                          bounds[vehicle]['min']['latitude'] = position['latitude']
-                          bounds[vehicle]['min']['longitude'] = position['longitude']
-                          bounds[vehicle]['min']['altitude'] = position['altitude']
-                          bounds[vehicle]['max']['latitude'] = position['latitude']
-                          bounds[vehicle]['max']['longitude'] = position['longitude']
-                          bounds[vehicle]['max']['altitude'] = position['altitude']
-              
-          # Now we've looped through all the bag files, extracting positions that fall within
-          # the deployment time span. Because topics get duplicated between vehicle and 
-          # operating station, we deduplicate them here.
-          for vehicle in deployment_tracks:
-            deployment_tracks[vehicle].sort()
-            dedup_track = []
-            dedup_track.append(deployment_tracks[vehicle][0])
-            for position in deployment_tracks[vehicle]:
-              if position != dedup_track[-1]:
-                dedup_track.append(position)
-            print('original:',len(deployment_tracks[vehicle]),'dedup:',len(dedup_track))
-            deployment_tracks[vehicle] = dedup_track
-            # Write the navigation file.
-            nav_file = output_path/sources/(vehicle+'.txt')
-            nav_file.parent.mkdir(parents=True, exist_ok=True)
-            print("Writing nav_file: %s" % nav_file)
-            nav = (nav_file).open('w')
-            for position in  deployment_tracks[vehicle]:
-              nav.write(position+'\n')
-            nav.close()
-            # Write the navigation bounds file.
-            bounds_path = output_path/sources/(vehicle+'_bounds.json')
-            bounds_path.parent.mkdir(parents=True, exist_ok=True)
-            print("Writing deployment spatial bounds: %s" % bounds_path)
-            bounds_file = bounds_path.open('w')
-            json.dump(bounds[vehicle],bounds_file)
-            # Write to kml.
-            print("Writing to kml.")
-            odm_utils.toKML(output_path/sources/(vehicle+'.kml'),deployment_tracks[vehicle], deployment_id+'_'+vehicle,{'Mothership':'mothership','DriX':'drix','Nautilus':'mothership','nui':'nui','Mesobot':'mesobot'}[vehicle])
-          
-
-
-
-
+        for sources in self.recording_sources:
+          # Find the logs from this source having timestamps within the bounds of the
+          # deployment start and end time.
+          bagfiles = self.overlapping(platform, start_time, end_time, sources)
+          print('  ',sources,len(bagfiles),'sources')
+          key = '/'.join((platform, deployment_id, sources))
+          configured.add(key)
+          inputs = self.input_signature(bagfiles)
+          previous = state.get(key)
+          if previous is not None and previous['deployment'] == d and previous['inputs'] == inputs and previous.get('settings') == settings:
+            if all(pathlib.Path(o).is_file() for o in previous['outputs']):
+              print('   unchanged')
+              new_state[key] = previous
+              continue
+          unit = DeploymentUnit(worker_project, key, d, sources, [track_store.track_meta(f) for f in bagfiles], start_time, end_time, output_path/sources, inputs)
+          units.append(unit)
 
+    # The units write to separate directories, so they run in parallel. Each one's
+    # messages are printed together when it finishes.
+    scheduler = WorkScheduler(self.process_count)
+    units_by_key = {u.key: u for u in units}
+    for key, outputs, log in scheduler.run(generateUnit, [(u,) for u in units], [u.fix_count() for u in units]):
+      unit = units_by_key[key]
+      print('\n'.join(log))
+      new_state[key] = {'deployment': unit.deployment, 'inputs': unit.inputs, 'settings': unit.settings, 'outputs': [str(o) for o in outputs]}
+    # Files written last time are removed only when their deployment is gone from
+    # deployments.json or their vehicle from position_topics.json. Those of a vehicle
+    # whose tracks didn't load this time are kept, and stay in the state.
+    vehicles = set(RosBagHandler.position_topics.values())
+    for key, p in previous_state.items():
+      current = set(new_state[key]['outputs']) if key in new_state else set()
+      for o in p['outputs']:
+        if o in current or not pathlib.Path(o).is_file():
+          continue
+        if key in configured and output_vehicle(pathlib.Path(o)) in vehicles:
+          if key in new_state:
+            new_state[key]['outputs'].append(o)
+          continue
+        print('removing', o)
+        pathlib.Path(o).unlink()
+    self.save_state(new_state)
 
@@ -1,46 +1,48 @@
 #!/usr/bin/env python3
 
 import pathlib
-import json
 from xmlrpc.client import Boolean
 
 from simplejson import JSONDecodeError
 
 class FileInfo:
-  def __init__(self, project, local_path: pathlib.Path = None, meta_path: pathlib.Path = None) -> None:
+  def __init__(self, project, local_path: pathlib.Path = None) -> None:
     self.project = project
     self.meta = None
     self.meta_updated = False
-    self.local_path = None
-    self.meta_path = None
+    self.local_path = local_path
     self.size = None
     self.modify_time = None
     self.file_exists = None
     self.meta_exists = None
+    self.source_file = None
     self.pending_processors = []
-    if local_path is not None:
-      self.local_path = local_path
-      self.meta_path = self.project.meta_path/self.local_path.parent/(self.local_path.name+'.meta.json')
-    elif meta_path is not None:
-      self.local_path = meta_path.relative_to(project.meta_path).parent/(meta_path.parts[-1][:-10])
-      self.meta_path = meta_path
+    # [local path, meta] for files handlers wrote, recorded by the project once the
+    # result is applied.
+    self.outputs = []
+    # local path: FileInfo of other files handlers look at, sent along to workers
+    # whose project has no file table.
+    self.related = {}
 
   def load_meta(self) -> Boolean:
     if self.meta_exists is None:
-      if self.meta_path is not None:
-        if self.meta_path.is_file():
-          try:
-            self.meta = json.load(open(self.meta_path))
-            self.meta_exists = True
-            return True
-          except json.decoder.JSONDecodeError as e:
-            print('error loading meta:', self.meta_path.absolute(),e)
+      if self.local_path is not None:
+        meta = self.project.meta_store.load(self.local_path)
+        if meta is not None:
+          self.set_meta(meta)
+          return True
         self.meta = {}
         self.meta_exists = False
+        self.state_changed()
         return True
       return False
     return True
 
+  def set_meta(self, meta):
+    self.meta = meta
+    self.meta_exists = True
+    self.state_changed()
+
   def update_from_source(self, force: Boolean = False) -> Boolean:
     if self.file_exists is None or force:
       if self.local_path is None:
@@ -48,14 +50,20 @@ class FileInfo:
       path = self.project.find_source_path(self.local_path)
       if path is None:
         self.file_exists = False
+        self.source_file = None
+        self.state_changed()
         return False
-      s = path.stat()
-      self.size = s.st_size
-      self.modify_time = s.st_mtime
-      self.file_exists = True
+      self.update_from_stat(path, path.stat())
       return True
     return self.file_exists
 
+  def update_from_stat(self, path: pathlib.Path, stat):
+    self.source_file = path
+    self.size = stat.st_size
+    self.modify_time = stat.st_mtime
+    self.file_exists = True
+    self.state_changed()
+
   def update_meta_value(self, handler, key, value):
     if self.meta is None:
       if not self.load_meta():
@@ -69,6 +77,16 @@ class FileInfo:
     self.meta[handler_label][key] = value
     return True
 
+  def remove_meta_value(self, handler, key):
+    if self.meta is None:
+      if not self.load_meta():
+        return False
+    handler_label = type(handler).__name__
+    if handler_label in self.meta and key in self.meta[handler_label]:
+      del self.meta[handler_label][key]
+      self.meta_updated = True
+    return True
+
   def has_meta_value(self, handler, key) -> Boolean:
     if self.meta is None:
       if not self.load_meta():
@@ -82,17 +100,20 @@ class FileInfo:
     handler_label = type(handler).__name__
     return self.meta[handler_label][key]
 
+  def state_changed(self):
+    # Lets the project keep its per directory stats current.
+    self.project.file_changed(self)
+
   def save_meta(self):
-    if self.meta_path is None:
+    if self.local_path is None:
       return False
     if self.file_exists:
       if not self.update_meta_value(self, 'size', self.size):
         return False
       if not self.update_meta_value(self, 'modify_time', self.modify_time):
         return False
-    self.meta_path.parent.mkdir(parents=True, exist_ok=True)
-    outfile = self.meta_path.open('w')
-    json.dump(self.meta, outfile)
+    self.project.meta_store.save(self.local_path, self.meta)
+    self.state_changed()
     return True
 
   def is_modified(self) -> Boolean:
@@ -118,17 +139,29 @@ class FileInfo:
     return ret
 
   def source_path(self) -> pathlib.Path:
+    if self.file_exists and self.source_file is not None:
+      return self.source_file
     return self.project.find_source_path(self.local_path)
 
   def add_processor(self, processor):
     processor_label = type(processor).__name__
     if not processor_label in self.pending_processors:
       self.pending_processors.append(processor_label)
+      self.state_changed()
+
+  def related_file(self, local_path: pathlib.Path):
+    if local_path in self.project.files:
+      return self.project.files[local_path]
+    return self.related.get(local_path)
+
+  def add_output(self, local_path: pathlib.Path, meta):
+    self.outputs.append([local_path, meta])
 
   def remove_processor(self, processor):
     processor_label = type(processor).__name__
     if processor_label in self.pending_processors:
       self.pending_processors.remove(processor_label)
+      self.state_changed()
 
   def needs_processing_by(self, processor):
     processor_label = type(processor).__name__
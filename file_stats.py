@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import pathlib
+
+from typing import Dict
+
+# Count and size of files per state, for every directory of a project, kept up to date
+# as files change so the stats of any subtree are a lookup. Each file's last
+# contribution is kept, and a change applies only the difference to the file's
+# directories. Files are tracked from their cached state alone, nothing is stat'ed
+# here; those whose existence or meta hasn't been looked at yet are left unresolved.
+
+def empty_stats() -> Dict:
+  return {
+    'total':{'count': 0, 'size':0},
+    'needs_processing':{'count': 0, 'size':0},
+    'new':{'count': 0, 'size':0},
+    'updated':{'count': 0, 'size':0},
+    'missing':{'count': 0}
+  }
+
+def contribution(file) -> Dict[str, int]:
+  # Category: size, or None while the file is unresolved.
+  if file.file_exists is False:
+    return {'missing': 0}
+  if file.file_exists is None or file.meta_exists is None:
+    return None
+  ret = {'total': file.size}
+  if not file.meta_exists:
+    ret['new'] = file.size
+  elif file.is_modified():
+    ret['updated'] = file.size
+  if file.needs_processing():
+    ret['needs_processing'] = file.size
+  return ret
+
+class FileStats:
+  def __init__(self):
+    # directory local path: stats, the project's root being pathlib.Path('.')
+    self.directories = {}
+    # directory local path: stats of it and each directory above it
+    self.chains = {}
+    # local path: [contribution, stats of each of its directories]
+    self.files = {}
+    self.unresolved = set()
+
+  def add(self, directories, values: Dict[str, int], sign: int):
+    for stats in directories:
+      for category, size in values.items():
+        stats[category]['count'] += sign
+        if category != 'missing':
+          stats[category]['size'] += sign*size
+
+  def chain(self, directory: pathlib.Path):
+    if not directory in self.chains:
+      self.directories[directory] = empty_stats()
+      if directory == directory.parent:
+        self.chains[directory] = [self.directories[directory]]
+      else:
+        self.chains[directory] = [self.directories[directory]]+self.chain(directory.parent)
+    return self.chains[directory]
+
+  def update(self, file):
+    local_path = file.local_path
+    new = contribution(file)
+    entry = self.files.get(local_path)
+    if entry is None:
+      entry = [None, self.chain(local_path.parent)]
+      self.files[local_path] = entry
+      if new is None:
+        self.unresolved.add(local_path)
+    old, directories = entry
+    if new == old:
+      return
+    if old is not None:
+      self.add(directories, old, -1)
+    if new is not None:
+      self.add(directories, new, 1)
+      self.unresolved.discard(local_path)
+    else:
+      self.unresolved.add(local_path)
+    entry[0] = new
+
+  def stats(self, path: pathlib.Path = None) -> Dict:
+    if path is None:
+      path = pathlib.Path('.')
+    if not path in self.directories:
+      return empty_stats()
+    return {category: dict(values) for category, values in self.directories[path].items()}
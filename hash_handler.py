@@ -1,28 +1,140 @@
 #!/usr/bin/env python3
 
 import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from file_info import FileInfo
 
+# Read strategies, selected with the 'hash' section of the project config:
+#   buffered    - fed by the shared read pipeline in buffer_size chunks (default)
+#   mmap        - hashes a read-only memory map of the file
+#   file_digest - hashlib.file_digest on the open file, buffered before Python 3.11
+#   tree        - hashes tree_chunk_size chunks in parallel threads, then hashes the
+#                 concatenated chunk digests. This is not a plain sha256 of the file so
+#                 it is recorded with its own label, e.g. sha256-tree-64M.
+default_settings = {
+  'strategy': 'buffered',
+  'buffer_size': 8*1024*1024,
+  'tree_chunk_size': 64*1024*1024,
+  'threads': 4,
+}
+
+def tree_chunk_size(label: str) -> int:
+  # The chunk size a sha256-tree-<size> label was hashed with, None for other labels.
+  prefix = 'sha256-tree-'
+  if not label.startswith(prefix):
+    return None
+  size = label[len(prefix):]
+  if size.endswith('M'):
+    return int(size[:-1])*1024*1024
+  return int(size)
+
 class HashHandler:
   def __init__(self):
     self.hasher = hashlib.sha256
     self.label = 'sha256'
+    self.settings = None
+
+  def configure(self, file: FileInfo):
+    if self.settings is None:
+      self.settings = dict(default_settings)
+      config = file.project.config
+      if config is not None and 'hash' in config:
+        self.settings.update(config['hash'])
+      if self.settings['strategy'] == 'file_digest' and not hasattr(hashlib, 'file_digest'):
+        # Same digest either way.
+        self.settings['strategy'] = 'buffered'
+      self.chunk_size = self.settings['buffer_size']
+      if self.settings['strategy'] == 'tree':
+        tree_chunk_size = self.settings['tree_chunk_size']
+        if tree_chunk_size % (1024*1024) == 0:
+          self.label = 'sha256-tree-'+str(tree_chunk_size//(1024*1024))+'M'
+        else:
+          self.label = 'sha256-tree-'+str(tree_chunk_size)
+
+  def recorded_label(self, file: FileInfo):
+    if file.has_meta_value(self, 'label'):
+      return file.get_meta_value(self, 'label')
+    return 'sha256'
 
   def needsProcessing(self, file: FileInfo):
-    if file.has_meta_value(self, 'hash') and not file.is_modified():
+    self.configure(file)
+    if file.has_meta_value(self, 'hash') and self.recorded_label(file) == self.label and not file.is_modified():
       return False
     return True
 
-  def process(self, file: FileInfo) -> FileInfo:
+  def access(self, file: FileInfo):
+    self.configure(file)
+    if self.settings['strategy'] == 'buffered':
+      return 'stream'
+    return 'random'
+
+  def begin(self, file: FileInfo):
+    self.hash = self.hasher()
+
+  def update(self, chunk):
+    self.hash.update(chunk)
+
+  def finish(self, file: FileInfo):
+    self.record(file, self.hash.hexdigest())
+
+  def record(self, file: FileInfo, digest):
+    file.update_meta_value(self, 'hash', digest)
+    file.update_meta_value(self, 'label', self.label)
+
+  def hash_mmap(self, source):
+    hash = self.hasher()
+    if os.fstat(source.fileno()).st_size > 0:
+      with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+          mapped.madvise(mmap.MADV_SEQUENTIAL)
+        hash.update(mapped)
+    return hash.hexdigest()
+
+  def hash_chunk(self, fd, offset, size):
+    hash = self.hasher()
+    end = offset+size
+    while offset < end:
+      data = os.pread(fd, min(self.settings['buffer_size'], end-offset), offset)
+      if not data:
+        break
+      hash.update(data)
+      offset += len(data)
+    return hash.digest()
+
+  def hash_tree(self, source):
+    # hashlib and pread release the GIL, so threads hash chunks concurrently.
+    fd = source.fileno()
+    size = os.fstat(fd).st_size
+    chunk_size = self.settings['tree_chunk_size']
+    offsets = range(0, size, chunk_size)
+    with ThreadPoolExecutor(max_workers=self.settings['threads']) as executor:
+      digests = executor.map(lambda offset: self.hash_chunk(fd, offset, chunk_size), offsets)
+      root = self.hasher()
+      for d in digests:
+        root.update(d)
+    return root.hexdigest()
+
+  def process(self, file: FileInfo, source = None) -> FileInfo:
     if self.needsProcessing(file):
-      hash = self.hasher()
-      sp = file.source_path()
-      if sp is not None:
-        with open(file.source_path(), 'rb') as f:
-          for chunk in iter(lambda: f.read(4096), b""):
-            hash.update(chunk)
-
-      file.update_meta_value(self, 'hash', hash.hexdigest())
+      if source is None:
+        sp = file.source_path()
+        if sp is None:
+          return file
+        with open(sp, 'rb') as f:
+          return self.process(file, f)
+      strategy = self.settings['strategy']
+      if strategy == 'mmap':
+        self.record(file, self.hash_mmap(source))
+      elif strategy == 'file_digest':
+        self.record(file, hashlib.file_digest(source, self.hasher).hexdigest())
+      elif strategy == 'tree':
+        self.record(file, self.hash_tree(source))
+      else:
+        self.begin(file)
+        for chunk in iter(lambda: source.read(self.settings['buffer_size']), b""):
+          self.update(chunk)
+        self.finish(file)
     return file
-
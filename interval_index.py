@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left, bisect_right
+
+from typing import List
+
+class IntervalIndex:
+  # Static index of (start, end, item) intervals for overlap queries. Intervals are
+  # sorted by start, and a running maximum of the ends bounds where overlaps can begin,
+  # so a query is two binary searches plus the candidates between them.
+
+  def __init__(self, intervals = ()):
+    intervals = sorted(intervals, key=lambda i: (i[0], i[1]))
+    self.starts = [i[0] for i in intervals]
+    self.ends = [i[1] for i in intervals]
+    self.items = [i[2] for i in intervals]
+    self.max_ends = []
+    max_end = None
+    for end in self.ends:
+      if max_end is None or end > max_end:
+        max_end = end
+      self.max_ends.append(max_end)
+
+  def __len__(self):
+    return len(self.items)
+
+  def overlapping(self, start, end) -> List:
+    # Items whose interval overlaps (start, end): item start < end and item end > start.
+    last = bisect_left(self.starts, end)
+    first = bisect_right(self.max_ends, start, 0, last)
+    return [self.items[i] for i in range(first, last) if self.ends[i] > start]
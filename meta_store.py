@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import json
+import pathlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from typing import Dict, Iterator, Tuple
+
+# Backends holding the per-file meta dictionaries ({handler_label: {key: value}}).
+# Both provide load, save, items, a batch context used by Project to group writes and
+# flush, called while waiting on work, to write out what a batch holds when it's due.
+
+class JsonMetaStore:
+  label = 'json'
+
+  def __init__(self, meta_path: pathlib.Path):
+    self.meta_path = meta_path
+
+  def sidecar_path(self, local_path: pathlib.Path) -> pathlib.Path:
+    return self.meta_path/local_path.parent/(local_path.name+'.meta.json')
+
+  def local_path(self, sidecar_path: pathlib.Path) -> pathlib.Path:
+    return sidecar_path.relative_to(self.meta_path).parent/(sidecar_path.parts[-1][:-10])
+
+  def load(self, local_path: pathlib.Path) -> Dict:
+    sidecar = self.sidecar_path(local_path)
+    if sidecar.is_file():
+      try:
+        with sidecar.open() as infile:
+          return json.load(infile)
+      except json.decoder.JSONDecodeError as e:
+        print('error loading meta:', sidecar.absolute(), e)
+    return None
+
+  def save(self, local_path: pathlib.Path, meta: Dict):
+    sidecar = self.sidecar_path(local_path)
+    sidecar.parent.mkdir(parents=True, exist_ok=True)
+    with sidecar.open('w') as outfile:
+      json.dump(meta, outfile)
+
+  def items(self) -> Iterator[Tuple[pathlib.Path, Dict]]:
+    for sidecar in self.meta_path.glob('**/*.meta.json'):
+      local_path = self.local_path(sidecar)
+      meta = self.load(local_path)
+      if meta is not None:
+        yield local_path, meta
+
+  @contextmanager
+  def batch(self):
+    yield self
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class SqliteMetaStore:
+  label = 'sqlite'
+
+  def __init__(self, db_path: pathlib.Path, batch_size: int = 500, commit_interval: float = 5.0):
+    self.db_path = db_path
+    self.batch_size = batch_size
+    # Seconds a batch's transaction stays open, holding the write lock.
+    self.commit_interval = commit_interval
+    self.connection = None
+    self.batch_depth = 0
+    self.pending = 0
+    self.transaction_start = None
+
+  # Connections can't cross process boundaries, so a copy sent to a worker reconnects lazily.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['connection'] = None
+    state['batch_depth'] = 0
+    state['pending'] = 0
+    state['transaction_start'] = None
+    return state
+
+  def connect(self) -> sqlite3.Connection:
+    if self.connection is None:
+      self.db_path.parent.mkdir(parents=True, exist_ok=True)
+      self.connection = sqlite3.connect(str(self.db_path), timeout=60, isolation_level=None)
+      self.connection.execute('PRAGMA journal_mode=WAL')
+      self.connection.execute('PRAGMA synchronous=NORMAL')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS meta (local_path TEXT NOT NULL, handler TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (local_path, handler)) WITHOUT ROWID')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS meta_handler ON meta (handler)')
+    return self.connection
+
+  def load(self, local_path: pathlib.Path) -> Dict:
+    rows = self.connect().execute('SELECT handler, value FROM meta WHERE local_path = ?', (str(local_path),)).fetchall()
+    if len(rows) == 0:
+      return None
+    return {handler: json.loads(value) for handler, value in rows}
+
+  def save(self, local_path: pathlib.Path, meta: Dict):
+    # Within a batch, a transaction is opened by the first row saved and committed
+    # after batch_size rows or commit_interval seconds.
+    connection = self.connect()
+    if self.transaction_start is None:
+      connection.execute('BEGIN IMMEDIATE')
+      self.transaction_start = time.monotonic()
+    key = str(local_path)
+    connection.execute('DELETE FROM meta WHERE local_path = ?', (key,))
+    connection.executemany('INSERT INTO meta (local_path, handler, value) VALUES (?, ?, ?)', [(key, handler, json.dumps(value)) for handler, value in meta.items()])
+    self.pending += 1
+    if self.batch_depth == 0 or self.pending >= self.batch_size:
+      self.commit()
+    else:
+      self.flush()
+
+  def commit(self):
+    if self.transaction_start is not None:
+      self.connection.execute('COMMIT')
+      self.transaction_start = None
+      self.pending = 0
+
+  def flush(self):
+    if self.transaction_start is not None and time.monotonic()-self.transaction_start >= self.commit_interval:
+      self.commit()
+
+  def items(self) -> Iterator[Tuple[pathlib.Path, Dict]]:
+    current_path = None
+    current_meta = None
+    for local_path, handler, value in self.connect().execute('SELECT local_path, handler, value FROM meta ORDER BY local_path'):
+      if local_path != current_path:
+        if current_path is not None:
+          yield pathlib.Path(current_path), current_meta
+        current_path = local_path
+        current_meta = {}
+      current_meta[handler] = json.loads(value)
+    if current_path is not None:
+      yield pathlib.Path(current_path), current_meta
+
+  @contextmanager
+  def batch(self):
+    # Each saved row is a file's whole meta, so what was saved is kept when the batch
+    # ends with an exception too.
+    self.batch_depth += 1
+    try:
+      yield self
+    finally:
+      self.batch_depth -= 1
+      if self.batch_depth == 0:
+        self.commit()
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+
+def open_meta_store(config_path: pathlib.Path, backend: str = 'json'):
+  if backend == 'json':
+    return JsonMetaStore(config_path/'meta')
+  if backend == 'sqlite':
+    return SqliteMetaStore(config_path/'meta.sqlite')
+  raise Exception('Unknown meta backend: '+str(backend))
+
+def migrate_sidecars(source: JsonMetaStore, destination, progress_callback = None) -> int:
+  count = 0
+  with destination.batch():
+    for local_path, meta in source.items():
+      destination.save(local_path, meta)
+      count += 1
+      if progress_callback is not None:
+        progress_callback(count)
+  return count
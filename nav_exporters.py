@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import json
+import struct
+import datetime
+import pathlib
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import odm_utils
+import track_store
+
+from typing import Dict
+
+# Writers for a deployment's merged vehicle track. The track comes in blocks, (4, n)
+# arrays of timestamp, latitude, longitude and altitude rows in time order, so the
+# whole track is never in memory. A writer is created with the output path without
+# its extension, gets update(block) for each block, and finish() returns the path
+# written. The formats a project writes are listed under 'nav_formats' in its config.
+
+default_formats = ['txt', 'kml']
+buffer_size = 1024*1024
+
+def utc_time(timestamp: float) -> str:
+  return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone(datetime.timedelta(0.0))).isoformat()
+
+class TxtExporter:
+  # One "iso time,epoch seconds,latitude,longitude,altitude" line per fix.
+  def __init__(self, path: pathlib.Path, label: str, style: str, settings: Dict):
+    self.path = path.parent/(path.name+'.txt')
+    self.out = self.path.open('w', buffering=buffer_size)
+
+  def update(self, block: np.ndarray):
+    self.out.write(''.join([utc_time(t)+','+str(t)+','+str(lat)+','+str(lon)+','+str(alt)+'\n' for t, lat, lon, alt in block.T.tolist()]))
+
+  def finish(self) -> pathlib.Path:
+    self.out.close()
+    return self.path
+
+class KmlExporter:
+  # Douglas-Peucker needs the whole line, so it simplifies runs of simplify_size fixes,
+  # each run starting at the last fix of the one before. The simplified line is
+  # thinned by half whenever it reaches twice max_points, which toKML would drop
+  # anyway.
+  simplify_size = 65536
+
+  def __init__(self, path: pathlib.Path, label: str, style: str, settings: Dict):
+    self.path = path.parent/(path.name+'.kml')
+    self.label = label
+    self.style = style
+    self.tolerance = settings['kml']['tolerance']
+    self.max_points = settings['kml']['max_points']
+    # Fixes not simplified yet.
+    self.pending = []
+    self.pending_count = 0
+    # The simplified line, every stride'th of the seen simplified fixes.
+    self.line = []
+    self.line_count = 0
+    self.stride = 1
+    self.seen = 0
+
+  def update(self, block: np.ndarray):
+    self.pending.append(block)
+    self.pending_count += block.shape[1]
+    if self.pending_count >= self.simplify_size:
+      self.simplify(False)
+
+  def simplify(self, last: bool):
+    run = np.concatenate(self.pending, axis=1)
+    line = track_store.simplify(run, self.tolerance)
+    if not last:
+      # Douglas-Peucker keeps the end points, so the run's last fix is left to start
+      # the next run.
+      self.pending = [run[:, -1:]]
+      self.pending_count = 1
+      line = line[:, :-1]
+    first = (-self.seen) % self.stride
+    self.seen += line.shape[1]
+    line = line[:, first::self.stride]
+    self.line.append(line)
+    self.line_count += line.shape[1]
+    if self.line_count >= 2*self.max_points:
+      line = np.concatenate(self.line, axis=1)[:, ::2]
+      self.line = [line]
+      self.line_count = line.shape[1]
+      self.stride *= 2
+
+  def finish(self) -> pathlib.Path:
+    if self.pending_count > 0:
+      self.simplify(True)
+    if self.line_count > 0:
+      track = np.concatenate(self.line, axis=1)
+    else:
+      track = np.empty((4, 0))
+    odm_utils.toKML(self.path, track, self.label, self.style, self.max_points)
+    return self.path
+
+class GeojsonExporter:
+  # A single LineString Feature of [longitude, latitude, altitude] positions. The
+  # properties follow the geometry since the end time is only known at the end.
+  def __init__(self, path: pathlib.Path, label: str, style: str, settings: Dict):
+    self.path = path.parent/(path.name+'.geojson')
+    self.properties = {'name': label}
+    self.out = self.path.open('w', buffering=buffer_size)
+    self.out.write('{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [')
+    self.separator = ''
+
+  def update(self, block: np.ndarray):
+    if block.shape[1] == 0:
+      return
+    if not 'start_time' in self.properties:
+      self.properties['start_time'] = utc_time(block[track_store.TIMESTAMP][0])
+    self.properties['end_time'] = utc_time(block[track_store.TIMESTAMP][-1])
+    self.out.write(self.separator+','.join(['['+str(lon)+','+str(lat)+','+str(alt)+']' for t, lat, lon, alt in block.T.tolist()]))
+    self.separator = ','
+
+  def finish(self) -> pathlib.Path:
+    self.out.write(']}, "properties": '+json.dumps(self.properties)+'}\n')
+    self.out.close()
+    return self.path
+
+class GpxExporter:
+  def __init__(self, path: pathlib.Path, label: str, style: str, settings: Dict):
+    self.path = path.parent/(path.name+'.gpx')
+    self.out = self.path.open('w', buffering=buffer_size)
+    self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="oeci_data_manager" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    self.out.write('  <trk>\n    <name>'+escape(label)+'</name>\n    <trkseg>\n')
+
+  def update(self, block: np.ndarray):
+    self.out.write(''.join(['      <trkpt lat="'+str(lat)+'" lon="'+str(lon)+'"><ele>'+str(alt)+'</ele><time>'+utc_time(t)[:-6]+'Z</time></trkpt>\n' for t, lat, lon, alt in block.T.tolist()]))
+
+  def finish(self) -> pathlib.Path:
+    self.out.write('    </trkseg>\n  </trk>\n</gpx>\n')
+    self.out.close()
+    return self.path
+
+class NpyExporter:
+  # The track as a (4, n) array loadable with numpy.load, rows as in track_store.
+  # Fixes are written one after the other as they come, which is the Fortran order
+  # layout of that array, and the header is rewritten with the count at the end.
+  header_size = 128
+
+  def __init__(self, path: pathlib.Path, label: str, style: str, settings: Dict):
+    self.path = path.parent/(path.name+'.npy')
+    self.count = 0
+    self.out = self.path.open('wb', buffering=buffer_size)
+    self.out.write(self.header())
+
+  def header(self) -> bytes:
+    text = "{'descr': '<f8', 'fortran_order': True, 'shape': (4, %d), }" % self.count
+    magic = np.lib.format.magic(1, 0)
+    text = text.ljust(self.header_size-len(magic)-3)+'\n'
+    return magic+struct.pack('<H', len(text))+text.encode('latin1')
+
+  def update(self, block: np.ndarray):
+    self.out.write(np.ascontiguousarray(block.T, dtype='<f8').tobytes())
+    self.count += block.shape[1]
+
+  def finish(self) -> pathlib.Path:
+    self.out.seek(0)
+    self.out.write(self.header())
+    self.out.close()
+    return self.path
+
+exporters = {
+  'txt': TxtExporter,
+  'kml': KmlExporter,
+  'geojson': GeojsonExporter,
+  'gpx': GpxExporter,
+  'npy': NpyExporter,
+}
+
+def register_exporter(name: str, exporter):
+  # exporter(path, label, style, settings) returns a writer with update(block) and
+  # finish() like the ones above.
+  exporters[name] = exporter
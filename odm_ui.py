@@ -73,14 +73,14 @@ class OECIDataManager(QMainWindow):
       self.progress_dialog.setWindowModality(QtCore.Qt.WindowModal)
       self.progress_dialog.setMaximum(total_count)
       self.progress_dialog.show()
-      project.scan(OECIDataManager.handlers, 1, self.on_scan_progress)
+      project.scan(OECIDataManager.handlers, self.processCountSpinBox.value(), self.on_scan_progress)
       self.progress_dialog.cancel()
       self.progress_dialog = None
       self.update_stats(project, self.projectStats)
       self.update_files()
       QApplication.restoreOverrideCursor()
 
-  def on_process_progress(self, processed_size):
+  def on_process_progress(self, processed_size, worker_stats=None, device_stats=None):
     if self.progress_dialog is not None:
       self.progress_dialog.setValue(processed_size/1024)
       if self.progress_dialog.wasCanceled():
@@ -106,7 +106,7 @@ class OECIDataManager(QMainWindow):
       project.process(OECIDataManager.handlers, pcount, self.on_process_progress)
       
       project.generate_manifest()
-      dgen = DrixDeployments(project)
+      dgen = DrixDeployments(project, process_count=pcount)
       dgen.generate()
 
       self.progress_dialog.cancel()
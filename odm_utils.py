@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import os
 import pathlib
 import math
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 
 # from https://stackoverflow.com/questions/1094841/get-human-readable-version-of-file-size
 def human_readable_size(size, decimal_places=3):
@@ -43,27 +46,43 @@ kml_style_template = '''
     </Style>
 '''
 
-def toKML(output_file: pathlib.Path, track, label, style):
+# track is a (4, n) array of timestamp, latitude, longitude and altitude rows. It is
+# written as it is formatted, a block at a time, with at most max_points positions.
+def toKML(output_file: pathlib.Path, track, label, style, max_points = 65536):
   styles = {}
   styles['drix'] = kml_style_template.format(style_id='drix', line_color='FF0000FF', poly_color='FF00007F')
   styles['mesobot'] = kml_style_template.format(style_id='mesobot', line_color='FF00FFFF', poly_color='7FFF00FF')
   styles['nui'] = kml_style_template.format(style_id='nui', line_color='FF00A5FF', poly_color='7F00A5FF')
   styles['mothership'] = kml_style_template.format(style_id='mothership', line_color='FFFF0000', poly_color='7FFF0000')
 
-  coordinates = ''
   skip = 1
-  max_points = 65536
-  if len(track) > max_points:
-    skip = math.ceil(len(track)/float(max_points))
-  for i in range(0,len(track),skip):
-    parts = track[i].split(',')
-    coordinates+= parts[3]+','+parts[2]+','+parts[4]+'\n'
+  count = track.shape[1]
+  if count > max_points:
+    skip = math.ceil(count/float(max_points))
+  head, tail = kml_template.split('{coordinates}')
 
   output_file.parent.mkdir(parents=True, exist_ok=True)
-  kml_out = output_file.open(mode='w')
-  kml_out.write(kml_template.format(name=label,style=styles[style],style_id=style, coordinates=coordinates))
+  with output_file.open(mode='w') as kml_out:
+    kml_out.write(head.format(name=escape(label),style=styles[style],style_id=style))
+    block_size = 4096*skip
+    for start in range(0, count, block_size):
+      block = track[:, start:start+block_size:skip]
+      kml_out.write(''.join([str(longitude)+','+str(latitude)+','+str(altitude)+'\n' for timestamp, latitude, longitude, altitude in block.T.tolist()]))
+    kml_out.write(tail)
 
-  kml_out.close()
+@contextmanager
+def atomic_write(path: pathlib.Path, mode: str = 'w'):
+  # Yields a file open on path+'.tmp' that replaces path once it's written, so
+  # readers never see it half written.
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(path.name+'.tmp')
+  try:
+    with tmp_path.open(mode) as outfile:
+      yield outfile
+  except:
+    tmp_path.unlink(missing_ok=True)
+    raise
+  os.replace(tmp_path, path)
 
 def resolvePath(path: pathlib.Path):
   ret = path.expanduser().resolve()
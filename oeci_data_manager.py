@@ -8,6 +8,8 @@ from hash_handler import HashHandler
 from ros_bag_handler import RosBagHandler
 from ros_bag_index_handler import RosBagIndexHandler
 from drix_deployments import DrixDeployments
+from scrubber import Scrubber
+import track_store
 
 from config import ConfigPath
 from project import Project
@@ -52,7 +54,7 @@ class ProcessProgress:
         self.latest_processed_sizes = []  # List to track processed sizes for rate calculation
         self.need_processing_size = need_processing_size  # Total size of data needing processing
 
-    def __call__(self, processed_size):
+    def __call__(self, processed_size, worker_stats=None, device_stats=None):
         now = datetime.datetime.now()
         self.latest_processed_sizes.append((now, processed_size))
         # Remove outdated entries from the size tracking list
@@ -65,6 +67,14 @@ class ProcessProgress:
             est_time_remaining = datetime.timedelta(seconds=(self.need_processing_size - processed_size) / avg_rate) if avg_rate > 0 else "?"
             percent_complete = (processed_size / self.need_processing_size) * 100
             print(f"Progress: {percent_complete:.1f}% | Avg Rate: {human_readable_size(avg_rate)}/s | Remaining: {est_time_remaining}")
+            # Per worker throughput while busy, to spot a worker stuck on a slow file or drive
+            if worker_stats:
+                rates = [f"{pid}: {stat['count']} files {human_readable_size(stat['size'] / stat['seconds'] if stat['seconds'] > 0 else 0)}/s" for pid, stat in sorted(worker_stats.items())]
+                print("  Workers: " + " | ".join(rates))
+            # Throughput per device since processing started
+            if device_stats:
+                rates = [f"{device}: {stat['count']} files {human_readable_size(stat['size'] / stat['elapsed'] if stat['elapsed'] > 0 else 0)}/s" for device, stat in sorted(device_stats.items())]
+                print("  Devices: " + " | ".join(rates))
             self.last_report_time = now
         return False
 
@@ -86,14 +96,41 @@ def parse_args():
     init_parser.add_argument("--source", required=True, help="Source directory")
     init_parser.add_argument("--label", help="Project label")
     init_parser.add_argument("--output", help="Output directory")
+    init_parser.add_argument("--meta_backend", choices=["json", "sqlite"], default="json", help="Storage for file metadata")
     # Scan command
     scan_parser = subparsers.add_parser("scan", parents=[parent_parser], help="Scan for files needing processing")
     scan_parser.add_argument("--project", required=True, help="Project to scan")
-    scan_parser.add_argument("--process_count", type=int, default=1, help="Number of jobs for processing")
+    scan_parser.add_argument("--process_count", type=int, default=1, help="Number of jobs for scanning")
+    scan_parser.add_argument("--full", action="store_true", help="Re-stat every file instead of skipping unchanged directories")
     # Process command
     process_parser = subparsers.add_parser("process", parents=[parent_parser], help="Process files")
     process_parser.add_argument("--project", required=True, help="Project to process")
     process_parser.add_argument("--process_count", type=int, default=1, help="Number of jobs for processing")
+    process_parser.add_argument("--device_concurrency", type=int, default=None, help="Number of files processed at once from each device (default from project config, or 2)")
+    process_parser.add_argument("--regenerate", action="store_true", help="Regenerate all deployment products, even unchanged ones")
+    # Migrate command
+    migrate_parser = subparsers.add_parser("migrate", parents=[parent_parser], help="Import .meta.json sidecars into the SQLite metadata store, or move tracks out of meta")
+    migrate_parser.add_argument("--project", required=True, help="Project to migrate")
+    migrate_parser.add_argument("--tracks", action="store_true", help="Move tracks stored in meta into track files, keeping the metadata backend unless --meta is also given")
+    migrate_parser.add_argument("--meta", action="store_true", help="Import sidecars into SQLite (the default without --tracks)")
+    # Manifest command
+    manifest_parser = subparsers.add_parser("manifest", parents=[parent_parser], help="Update or verify the manifest")
+    manifest_parser.add_argument("--project", required=True, help="Project whose manifest to update or verify")
+    manifest_parser.add_argument("--verify", action="store_true", help="Check the existing manifest against the recorded hashes")
+    manifest_parser.add_argument("--force", action="store_true", help="Rewrite the manifest even if no entry changed")
+    # Scrub command
+    scrub_parser = subparsers.add_parser("scrub", parents=[parent_parser], help="Re-hash the files verified longest ago to check for corruption")
+    scrub_parser.add_argument("--project", required=True, help="Project to scrub")
+    scrub_parser.add_argument("--rate", type=float, default=None, help="Read rate limit in MB/s (default from project config, or 50)")
+    scrub_parser.add_argument("--max_size", type=float, default=None, help="Stop after reading this many MB")
+    scrub_parser.add_argument("--max_time", type=float, default=None, help="Stop after this many minutes (default from project config, or 60)")
+    # Query command
+    query_parser = subparsers.add_parser("query", parents=[parent_parser], help="Find bags by position and time")
+    query_parser.add_argument("--project", required=True, help="Project to query")
+    query_parser.add_argument("--bbox", type=float, nargs=4, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"), help="Bounding box in degrees")
+    query_parser.add_argument("--start", help="Start time, ISO format, UTC unless given")
+    query_parser.add_argument("--end", help="End time, ISO format, UTC unless given")
+    query_parser.add_argument("--vehicle", help="Only bags with positions of this vehicle, as named in position_topics.json")
     # GUI command (no additional arguments)
     subparsers.add_parser("gui", parents=[parent_parser], help="Launch graphical interface")
 
@@ -139,7 +176,7 @@ def main():
         output = pathlib.Path(args.output) if args.output else source
 
         try:
-            project = config.create_project(label, source, output)
+            project = config.create_project(label, source, output, args.meta_backend)
             if verbose:
                 print(f"Project created: {project.label} (Source: {project.source}, Output: {project.output})")
         except Exception as e:
@@ -159,11 +196,11 @@ def main():
             if verbose:
                 print("Scanning source...")
             # Scan source files and print progress if verbose
-            project.scan_source(SourceScanProgress() if verbose else None)
+            project.scan_source(SourceScanProgress() if verbose else None, full=args.full)
 
             if verbose:
                 print("Scanning for files needing processing...")
-            project.scan([HashHandler, RosBagIndexHandler, RosBagHandler], 1, ScanProgress(len(project.files)) if verbose else None)
+            project.scan([HashHandler, RosBagIndexHandler, RosBagHandler], process_count, ScanProgress(len(project.files)) if verbose else None)
 
             if verbose:
                 # Generate and display statistics about the scanned files
@@ -178,13 +215,87 @@ def main():
             if verbose:
                 print(f"Files to process: {stats['needs_processing']['count']} ({human_readable_size(stats['needs_processing']['size'])})")
 
-            project.process([HashHandler, RosBagIndexHandler, RosBagHandler], process_count, ProcessProgress(stats['needs_processing']['size']) if verbose else None)
+            project.process([HashHandler, RosBagIndexHandler, RosBagHandler], process_count, ProcessProgress(stats['needs_processing']['size']) if verbose else None, args.device_concurrency)
             try:
                 project.generate_manifest()
             except Exception as e:
                 print(f"Error generating manifest: {e}")
-            dgen = DrixDeployments(project)
-            dgen.generate()
+            dgen = DrixDeployments(project, process_count=process_count)
+            dgen.generate(args.regenerate)
+
+    elif command == "migrate":
+        # Handle "migrate" command to move sidecar metadata into SQLite and/or tracks
+        # out of the metadata, whichever backend it is in
+        project = config.get_project(args.project)
+        if not project.valid():
+            print(f"Invalid project: {args.project}")
+            exit(1)
+        if args.meta or not args.tracks:
+            count = project.migrate_meta("sqlite", SourceScanProgress() if verbose else None)
+            print(f"Migrated {count} meta files to {project.meta_store.db_path}")
+        if args.tracks:
+            project.load()
+            count = track_store.externalize_project_tracks(project)
+            print(f"Moved tracks of {count} files to {track_store.tracks_path(project)}")
+
+    elif command == "manifest":
+        # Handle "manifest" command, comparing against the meta without re-reading files
+        project = config.get_project(args.project)
+        if not project.valid():
+            print(f"Invalid project: {args.project}")
+            exit(1)
+        project.load()
+        if args.verify:
+            try:
+                result = project.verify_manifest()
+            except OSError as e:
+                print(f"Error reading manifest: {e}")
+                exit(1)
+            for label, paths in result.items():
+                print(f"{label}: {len(paths)} files")
+                if verbose:
+                    for path in paths:
+                        print(f"  {path}")
+            if any(result.values()):
+                exit(1)
+        elif project.generate_manifest(args.force):
+            print(f"Manifest written: {project.find_output_path(project.manifest_file)}")
+        else:
+            print("Manifest unchanged")
+
+    elif command == "scrub":
+        # Handle "scrub" command, verifying a slice of the archive against recorded hashes
+        project = config.get_project(args.project)
+        if not project.valid():
+            print(f"Invalid project: {args.project}")
+            exit(1)
+        project.load()
+        def scrub_progress(file, result, read_size):
+            if verbose or result != 'ok':
+                print(f"{result}: {file.local_path} ({human_readable_size(read_size)} read)")
+        results = Scrubber(project, args.rate, args.max_size, args.max_time).run(scrub_progress)
+        for result, count in sorted(results.items()):
+            print(f"{result}: {count} files")
+        if results.get('mismatch', 0) > 0:
+            exit(1)
+
+    elif command == "query":
+        # Handle "query" command using the project's spatio-temporal index
+        project = config.get_project(args.project)
+        if not project.valid():
+            print(f"Invalid project: {args.project}")
+            exit(1)
+        times = []
+        for value in (args.start, args.end):
+            if value is None:
+                times.append(None)
+                continue
+            time = datetime.datetime.fromisoformat(value)
+            if time.tzinfo is None:
+                time = time.replace(tzinfo=datetime.timezone.utc)
+            times.append(time.timestamp())
+        for file in project.query(args.bbox, times[0], times[1], args.vehicle):
+            print(file.local_path)
 
     elif command == "gui":
         # Launch the GUI if "gui" command is issued
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+
+from file_info import FileInfo
+
+# Runs a file's pending handlers with the source opened once.
+#
+# Handlers declare how they read the source with access(file):
+#   'stream' - begin(file), update(chunk) for every chunk in file order, then finish(file).
+#              All streaming handlers are fed from the same sequential pass, using the
+#              largest chunk_size any of them asks for.
+#   'random' - process(file, source) with the shared, seekable source file object.
+#              The handler must not close it.
+# Handlers without an access method are called as process(file) and open the file themselves.
+
+default_chunk_size = 1024*1024
+
+def access_mode(processor, file: FileInfo) -> str:
+  if hasattr(processor, 'access'):
+    return processor.access(file)
+  return 'path'
+
+def stream_source(fd, consumers, chunk_size: int) -> int:
+  # pread leaves the file position alone for the random access handlers.
+  if hasattr(os, 'posix_fadvise'):
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+  offset = 0
+  while True:
+    chunk = os.pread(fd, chunk_size, offset)
+    if not chunk:
+      break
+    offset += len(chunk)
+    for c in consumers:
+      c.update(chunk)
+  return offset
+
+def run_pipeline(file: FileInfo, processors, chunk_size: int = default_chunk_size) -> FileInfo:
+  selected = [p for p in processors if file.needs_processing_by(p)]
+  modes = [access_mode(p, file) for p in selected]
+  source_path = file.source_path()
+
+  if source_path is None or not ('stream' in modes or 'random' in modes):
+    for processor in selected:
+      processor.process(file)
+      file.remove_processor(processor)
+    return file
+
+  try:
+    source = open(source_path, 'rb')
+  except OSError as e:
+    print('error opening', file.local_path, e)
+    return file
+
+  with source:
+    streamed = False
+    for processor, mode in zip(selected, modes):
+      if mode == 'stream':
+        # The first streaming handler triggers the shared pass for all of them.
+        if not streamed:
+          consumers = [p for p, m in zip(selected, modes) if m == 'stream']
+          for c in consumers:
+            c.begin(file)
+          stream_source(source.fileno(), consumers, max([chunk_size]+[getattr(c, 'chunk_size', 0) for c in consumers]))
+          for c in consumers:
+            c.finish(file)
+          streamed = True
+      elif mode == 'random':
+        source.seek(0)
+        processor.process(file, source)
+      else:
+        processor.process(file)
+      file.remove_processor(processor)
+  return file
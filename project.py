@@ -1,49 +1,65 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import pathlib
 import json
-import time
 import datetime
 
-from multiprocessing import Pool
 from hash_handler import HashHandler
 
-from odm_utils import resolvePath
+from odm_utils import resolvePath, atomic_write
 from file_info import FileInfo
+from meta_store import JsonMetaStore, open_meta_store, migrate_sidecars
+from source_walker import walk_files, load_snapshot, save_snapshot
+from pipeline import run_pipeline
+from scheduler import WorkScheduler
+from work_unit import WorkUnit, ResultDelta
+from spatial_index import SpatialIndex
+from file_stats import FileStats
 
 from typing import Dict, Iterator, List
 
-def previewFile(file: FileInfo, handler_list):
+# Project shell set in each worker by init_worker; it has no file table.
+worker_project = None
+
+def init_worker(project):
+  global worker_project
+  worker_project = project
+
+def processUnit(unit: WorkUnit, handler_list) -> ResultDelta:
   pipeline = []
   for h in handler_list:
     pipeline.append(h())
-    
-  for processor in pipeline:
-    if file.source_path() is not None:
-      if processor.needsProcessing(file):
-        file.add_processor(processor)
-  return file
 
-def processFile(file: FileInfo, handler_list):
+  file = unit.file_info(worker_project)
+  run_pipeline(file, pipeline)
+  return ResultDelta(unit, file)
+
+def previewUnit(unit: WorkUnit, handler_list) -> ResultDelta:
   pipeline = []
   for h in handler_list:
     pipeline.append(h())
 
+  file = unit.file_info(worker_project)
   for processor in pipeline:
-    if file.needs_processing_by(processor):
-      processor.process(file)
-      file.remove_processor(processor)
-  file.save_meta()
-  return file
+    if file.source_path() is not None:
+      if processor.needsProcessing(file):
+        file.add_processor(processor)
+  return ResultDelta(unit, file)
 
 class Project:
   def __init__(self, config_path: pathlib.Path):
     self.config_path = config_path
     self.files = {}
+    self.file_stats = FileStats()
     self.ignore_list = []
     self.label = config_path.parts[-1]
     self.config_file = config_path/'config.json'
     self.meta_path = config_path/'meta'
+    self.scan_snapshot_file = config_path/'scan_snapshot.json'
+    self.manifest_state_file = config_path/'manifest_state.json'
+    self.meta_store = None
     if self.config_file.exists():
       try:
         self.config = json.load(self.config_file.open())
@@ -51,6 +67,7 @@ class Project:
         self.output = pathlib.Path(self.config['output'])
         self.manifest_file = self.source/'manifest.txt'
         self.ignore_list.append(self.manifest_file)
+        self.meta_store = open_meta_store(self.config_path, self.config.get('meta_backend', 'json'))
       except:
         raise Exception('Error reading config file:'+str(self.config_file))
     else:
@@ -63,7 +80,7 @@ class Project:
   def valid(self):
     return self.config is not None
 
-  def create(self, source: pathlib.Path, output: pathlib.Path = None):
+  def create(self, source: pathlib.Path, output: pathlib.Path = None, meta_backend: str = 'json'):
     if self.valid():
       raise Exception("Can't create project, config alredy exists: "+str(self.config_file))
     try:
@@ -79,22 +96,78 @@ class Project:
         self.output = resolvePath(output)
       except RuntimeError:
         raise Exception("Can't resolve output path "+str(output))
-    self.config = {'source': str(self.source), 'output': str(self.output)}
+    self.meta_store = open_meta_store(self.config_path, meta_backend)
+    self.config = {'source': str(self.source), 'output': str(self.output), 'meta_backend': meta_backend}
     self.manifest_file = self.source/'manifest.txt'
     self.ignore_list.append(self.manifest_file)
+    self.save_config()
+
+  def save_config(self):
     if not self.config_path.is_dir():
       self.config_path.mkdir(parents=True)
-    json.dump(self.config, self.config_file.open("w"))
+    with self.config_file.open("w") as config_out:
+      json.dump(self.config, config_out)
 
   def load(self):
-    for f in self.meta_path.glob("**/*.meta.json"):
-      local_path = f.relative_to(self.meta_path)
+    for local_path, meta in self.meta_store.items():
       if local_path in self.files:
         self.files[local_path].load_meta()
       else:
-        fi = FileInfo(self, meta_path=f)
-        if fi.load_meta():
-          self.files[fi.local_path] = fi
+        fi = FileInfo(self, local_path=local_path)
+        self.files[local_path] = fi
+        fi.set_meta(meta)
+
+  def migrate_meta(self, backend: str, progress_callback = None) -> int:
+    if backend == self.config.get('meta_backend', 'json'):
+      return 0
+    if backend != 'sqlite':
+      raise Exception("Can only migrate json sidecars to sqlite, not: "+str(backend))
+    destination = open_meta_store(self.config_path, backend)
+    count = migrate_sidecars(JsonMetaStore(self.meta_path), destination, progress_callback)
+    self.meta_store.close()
+    self.meta_store = destination
+    self.config['meta_backend'] = backend
+    self.save_config()
+    return count
+
+  def apply_result(self, result: ResultDelta) -> FileInfo:
+    file = result.apply(self.files[result.local_path])
+    file.save_meta()
+    for local_path, meta in result.outputs:
+      self.record_output(local_path, meta)
+    return file
+
+  def record_output(self, local_path: pathlib.Path, meta):
+    # Meta a handler recorded for a file it wrote. It only holds while the file has the
+    # size and modify time it was written with, given under 'FileInfo'.
+    if not local_path in self.files:
+      self.files[local_path] = FileInfo(self, local_path=local_path)
+    file = self.files[local_path]
+    file.load_meta()
+    if not file.update_from_source(True):
+      return
+    written = meta.get('FileInfo', {})
+    if written.get('size') != file.size or written.get('modify_time') != file.modify_time:
+      return
+    for handler_label, values in meta.items():
+      if not handler_label in file.meta:
+        file.meta[handler_label] = {}
+      file.meta[handler_label].update(values)
+    file.meta_updated = True
+    file.save_meta()
+
+  def worker_copy(self):
+    # Everything handlers need from the project except the table of every file.
+    ret = Project.__new__(Project)
+    ret.__dict__.update(self.__dict__)
+    ret.files = {}
+    ret.file_stats = None
+    return ret
+
+  def file_changed(self, file: FileInfo):
+    # Only files of the table count, not the copies handlers and queries work on.
+    if self.file_stats is not None and self.files.get(file.local_path) is file:
+      self.file_stats.update(file)
 
   def __call__(self, path: pathlib.Path = None) -> Iterator[FileInfo]:
     for f in self.files:
@@ -106,13 +179,22 @@ class Project:
       return self.files[local_path]
 
   def source_files(self) -> Iterator[pathlib.Path]:
-    for f in self.source.glob("**/*"):
-      if f.is_file():
-        yield f
+    for local_path, path, stat in self.source_records():
+      yield path
+
+  def source_records(self, thread_count=8, snapshot=None, new_snapshot=None) -> Iterator:
+    # Yields (local_path, path, stat) for each file, with source taking precedence
+    # over output when a file is in both, matching find_source_path.
+    seen = set()
+    for path, stat in walk_files(self.source, thread_count, snapshot, new_snapshot):
+      local_path = path.relative_to(self.source)
+      seen.add(local_path)
+      yield local_path, path, stat
     if self.source != self.output:
-      for f in self.output.glob("**/*"):
-        if f.is_file():
-          yield f
+      for path, stat in walk_files(self.output, thread_count, snapshot, new_snapshot):
+        local_path = path.relative_to(self.output)
+        if not local_path in seen:
+          yield local_path, path, stat
 
   def structure(self) -> Dict:
     ret = {}
@@ -149,112 +231,176 @@ class Project:
         ret.append(p.parts[-1])
     return ret
 
-  def scan_source(self, progress_callback = None):
+  def scan_source(self, progress_callback = None, thread_count=8, full=False):
+    # Directories unchanged since the last scan reuse their recorded listing and file
+    # stats. Files rewritten in place don't change their directory's mtime, so use
+    # full to re-stat everything.
+    snapshot = None
+    if not full:
+      snapshot = load_snapshot(self.scan_snapshot_file)
+    new_snapshot = {}
     if progress_callback is not None:
       count = 0
       last_report_time = datetime.datetime.now()
-    for potential_file in self.source_files():
-      if self.source in potential_file.parents:
-        local_path = potential_file.relative_to(self.source)
-      else:
-        local_path = potential_file.relative_to(self.output)
+    for local_path, path, stat in self.source_records(thread_count, snapshot, new_snapshot):
       if not local_path in self.files:
         fi = FileInfo(self, local_path=local_path)
         fi.load_meta()
         self.files[local_path] = fi
-      self.files[local_path].update_from_source(True)
+      self.files[local_path].update_from_stat(path, stat)
       if progress_callback is not None:
         count += 1
         now = datetime.datetime.now()
         if now - last_report_time > self.progress_interval:
           progress_callback(count)
           last_report_time = now
+    save_snapshot(self.scan_snapshot_file, new_snapshot)
 
   def scan(self, handlers, process_count=1, progress_callback = None):
     scanned_count = 0
-
+    scheduler = WorkScheduler(process_count, self.progress_interval, init_worker, (self.worker_copy() if process_count > 1 else self,))
     if progress_callback is not None:
       last_report_time = datetime.datetime.now()
 
-    if process_count > 1:
-      pool = Pool(processes=process_count)
-      results_list = []
+    def progress():
+      nonlocal last_report_time
+      now = datetime.datetime.now()
+      if now - last_report_time > self.progress_interval:
+        last_report_time = now
+        return progress_callback(scanned_count)
+      return False
+
+    # The pending handler lists found by the workers are merged back into self.files.
+    files = list(self.files.values())
+    for result in scheduler.run(previewUnit, [(WorkUnit(f), handlers) for f in files], None, progress if progress_callback is not None else None):
+      result.apply(self.files[result.local_path])
+      scanned_count += 1
+
+  def process(self, handlers, process_count=1, progress_callback = None, device_concurrency = None):
+    with self.meta_store.batch():
+      processed = self.process_files(handlers, process_count, progress_callback, device_concurrency)
+    self.update_spatial_index(processed)
+
+  def default_device_concurrency(self) -> int:
+    if self.config is not None and 'device_concurrency' in self.config:
+      setting = self.config['device_concurrency']
+      if isinstance(setting, dict):
+        return setting.get('default', 2)
+      return setting
+    return 2
+
+  def device_limits(self) -> Dict:
+    # st_dev: limit for the devices given their own limit in the config, as
+    # "device_concurrency": {"default": 2, "/mnt/raid": 6}.
+    ret = {}
+    if self.config is not None and isinstance(self.config.get('device_concurrency'), dict):
+      for path, limit in self.config['device_concurrency'].items():
+        if path == 'default':
+          continue
+        try:
+          ret[os.stat(path).st_dev] = limit
+        except OSError as e:
+          print('device_concurrency:', e)
+    return ret
 
-    for f in self.files:
-      if process_count > 1:
-        while len(results_list) >= process_count*2:
-          done_list = []
-          for r in results_list:
-            if r.ready():
-              done_list.append(r)
-          if len(done_list):
-            for d in done_list:
-              d.get()
-              scanned_count += 1
-              results_list.remove(d)
-          else:
-            time.sleep(.05)
-        results_list.append(pool.apply_async(previewFile,(self.files[f], handlers)))
-      else:
-        f = previewFile(self.files[f], handlers)
-        scanned_count += 1
-      if progress_callback is not None:
-        now = datetime.datetime.now()
-        if now - last_report_time > self.progress_interval:
-          if progress_callback(scanned_count):
-            return
-          last_report_time = now
-    if process_count > 1:
-      for r in results_list:
-        r.wait()
-        f = r.get()
-        scanned_count += 1
-
-  def process(self, handlers, process_count=1, progress_callback = None):
-    processed_count = 0
+  def process_files(self, handlers, process_count=1, progress_callback = None, device_concurrency = None):
+    # progress_callback(processed_size, worker_stats, device_stats) returns True to
+    # cancel. worker_stats maps each worker's pid to its completed count, size and busy
+    # seconds, device_stats each device to the same plus the elapsed seconds.
+    # At most device_concurrency files are worked on at once per device (st_dev), read
+    # from or written to, so one disk isn't thrashed while another mount sits idle.
+    if device_concurrency is None:
+      device_concurrency = self.default_device_concurrency()
     processed_size = 0
+    # Workers get a project without its file table; inline runs can use this one.
+    scheduler = WorkScheduler(process_count, self.progress_interval, init_worker, (self.worker_copy() if process_count > 1 else self,), device_concurrency, self.device_limits())
+
+    def progress():
+      # Also called while waiting on the workers, so the results applied so far are
+      # committed every few seconds.
+      self.meta_store.flush()
+      if progress_callback is None:
+        return False
+      return progress_callback(processed_size, scheduler.worker_stats, scheduler.group_stats)
+
+    files = [file for file in self.files.values() if file.needs_processing()]
+    devices = {}
+    writers = [h() for h in handlers if hasattr(h, 'writes_output')]
+
+    def file_devices(file):
+      ret = (self.source_device(file, devices),)
+      for writer in writers:
+        if file.needs_processing_by(writer) and writer.writes_output(file):
+          return ret+(self.output_device(file, devices),)
+      return ret
 
-    if process_count > 1:
-      pool = Pool(processes=process_count)
-      results_list = []
+    processed = []
+    for result in scheduler.run(processUnit, [(WorkUnit(file), handlers) for file in files], [file.size or 0 for file in files], progress, [file_devices(file) for file in files]):
+      f = self.apply_result(result)
+      processed_size += f.size or 0
+      processed.append(f)
+    return processed
+
+  def spatial_index(self) -> SpatialIndex:
+    # Built from the meta of every file the first time, and not saved while the
+    # project has no files.
+    index = SpatialIndex(self)
+    if not index.load():
+      if len(self.files) == 0:
+        self.load()
+      if len(self.files) > 0:
+        index.build(self.files.values())
+    return index
+
+  def update_spatial_index(self, files: List[FileInfo]):
+    if len(files) == 0:
+      return
+    index = SpatialIndex(self)
+    if index.load():
+      index.update(files)
+    else:
+      self.spatial_index()
 
-    for f in self.files:
-      file = self.files[f]
-      if file.needs_processing():
-        if process_count > 1:
-          while len(results_list) >= process_count*2:
-            done_list = []
-            for r in results_list:
-              if r.ready():
-                done_list.append(r)
-            if len(done_list):
-              for d in done_list:
-                f = d.get()
-                processed_count += 1
-                processed_size += f.size
-                results_list.remove(d)
-            else:
-              time.sleep(.05)
-              if progress_callback is not None:
-                if progress_callback(processed_size):
-                  return
-          results_list.append(pool.apply_async(processFile,(file, handlers)))
-        else:
-          f = processFile(file, handlers)
-          processed_count += 1
-          processed_size += f.size
-        if progress_callback is not None:
-          if progress_callback(processed_size):
-            return
-
-        
-    if process_count > 1:
-      for r in results_list:
-        r.wait()
-        f = r.get()
-        processed_count += 1
-        processed_size += f.size
+  def query(self, bbox = None, start_time: float = None, end_time: float = None, vehicle: str = None) -> List[FileInfo]:
+    # Bags that saw vehicle (or any vehicle) inside bbox, (min latitude, min longitude,
+    # max latitude, max longitude), between start_time and end_time. Only the matching
+    # files' meta is loaded.
+    ret = []
+    for local_path in self.spatial_index().query(bbox, start_time, end_time, vehicle):
+      local_path = pathlib.Path(local_path)
+      if local_path in self.files:
+        ret.append(self.files[local_path])
+      else:
+        fi = FileInfo(self, local_path=local_path)
+        fi.load_meta()
+        ret.append(fi)
+    return ret
 
+  def device(self, directory: pathlib.Path, devices = None):
+    # st_dev of directory, or of the closest directory above it that exists. Files share
+    # their directory's device, so devices caches it per directory.
+    if devices is not None and directory in devices:
+      return devices[directory]
+    device = None
+    for d in [directory]+list(directory.parents):
+      try:
+        device = os.stat(d).st_dev
+        break
+      except OSError:
+        pass
+    if devices is not None:
+      devices[directory] = device
+    return device
+
+  def source_device(self, file: FileInfo, devices = None):
+    path = file.source_path()
+    if path is None:
+      return None
+    return self.device(path.parent, devices)
+
+  def output_device(self, file: FileInfo, devices = None):
+    # Where handlers write the file's products.
+    return self.device((self.output/file.local_path).parent, devices)
 
   def find_processing_path_from_raw(self, path: pathlib.Path) -> pathlib.Path:
     ret = pathlib.Path(path.parts[0])
@@ -279,47 +425,84 @@ class Project:
     return None
 
   def generate_file_stats(self, path: pathlib.Path = None):
-    ret = {
-      'total':{'count': 0, 'size':0},
-      'needs_processing':{'count': 0, 'size':0},
-      'new':{'count': 0, 'size':0},
-      'updated':{'count': 0, 'size':0},
-      'missing':{'count': 0}
-    }
-
-    for file in self(path):
-      if not file.update_from_source():
-        ret['missing']['count'] += 1
+    # Files are stat'ed and their meta loaded the first time they're counted; after
+    # that the stats follow their changes.
+    for local_path in list(self.file_stats.unresolved):
+      file = self.files[local_path]
+      file.update_from_source()
+      file.load_meta()
+    return self.file_stats.stats(path)
+
+  def manifest_entries(self, report_missing: bool = True) -> Dict[str, List[str]]:
+    # Local path: [hash, label] for every file that isn't known to be missing. Files
+    # aren't stat'ed here; whether they exist comes from the last scan or stats pass.
+    entries = {}
+    manifest_path = self.manifest_file.relative_to(self.source)
+    for f, fi in self.files.items():
+      if f == manifest_path or fi.file_exists is False:
+        continue
+      if fi.meta is not None and 'HashHandler' in fi.meta and 'hash' in fi.meta['HashHandler']:
+        entries[str(f)] = [fi.meta['HashHandler']['hash'], fi.meta['HashHandler'].get('label', 'sha256')]
       else:
-        ret['total']['count'] += 1
-        ret['total']['size'] += file.size
-        if file.load_meta():
-          if not file.meta_exists:
-            ret['new']['count'] += 1
-            ret['new']['size'] += file.size
-          else:
-            if file.is_modified():
-              ret['updated']['count'] += 1
-              ret['updated']['size'] += file.size
-        if file.needs_processing():
-          ret['needs_processing']['count'] += 1
-          ret['needs_processing']['size'] += file.size
-    return ret
+        if report_missing:
+          print('missing hash:', f)
+        entries[str(f)] = ['', 'sha256']
+    return entries
 
-  def generate_manifest(self):
-    manifest = []
-    for f in sorted(self.files):
-      fi = self.files[f]
-      if fi.status() != 'missing':
-        if fi.meta is not None and 'HashHandler' in fi.meta:
-          manifest.append((f,fi.meta['HashHandler']['hash']))
+  def load_manifest_state(self) -> Dict[str, List[str]]:
+    if self.manifest_state_file.is_file():
+      try:
+        with self.manifest_state_file.open() as infile:
+          return json.load(infile)
+      except json.decoder.JSONDecodeError as e:
+        print('error loading manifest state:', self.manifest_state_file, e)
+    return None
+
+  def generate_manifest(self, force: bool = False) -> bool:
+    # Plain sha256 entries use the sha256sum format. Other hash labels (tree hashes)
+    # use the tagged "LABEL (path) = hash" form so they can't be mistaken for sha256.
+    # The entries last written are kept in the config directory, and the manifest is
+    # only rewritten, atomically, when they changed. Returns True when it was written.
+    manifest_path = self.find_output_path(self.manifest_file)
+    entries = self.manifest_entries()
+    if not force and manifest_path.is_file() and self.load_manifest_state() == entries:
+      return False
+    with atomic_write(manifest_path) as manifest_file:
+      for f in sorted(entries, key=pathlib.Path):
+        file_hash, label = entries[f]
+        if label == 'sha256':
+          manifest_file.write(file_hash+'  '+f+'\n')
         else:
-          print('missing hash:', f)
-          manifest.append((f,''))
-    manifest_file = open(self.find_output_path(self.manifest_file),'w')
-    for f in manifest:
-      if f[0] != self.manifest_file:
-        manifest_file.write(str(f[1])+'  '+str(f[0])+'\n')
-    manifest_file.close() 
+          manifest_file.write(label.upper()+' ('+f+') = '+file_hash+'\n')
+    with atomic_write(self.manifest_state_file) as outfile:
+      json.dump(entries, outfile)
+    return True
+
+  def verify_manifest(self) -> Dict[str, List[str]]:
+    # Reads the manifest line by line and compares it with the hashes in the meta,
+    # without touching the files themselves. Returns the local paths that are
+    # 'mismatched' (different hash or label), 'unknown' (listed but not in the project
+    # or without a hash) and 'unlisted' (hashed in the project but not listed).
+    ret = {'mismatched': [], 'unknown': [], 'unlisted': []}
+    expected = self.manifest_entries(False)
+    with self.find_output_path(self.manifest_file).open() as manifest_file:
+      for line in manifest_file:
+        line = line.rstrip('\n')
+        match = re.fullmatch(r'(\S+) \((.*)\) = (\S*)', line)
+        if match is not None:
+          # Tagged lines have the label upper cased.
+          label, f, file_hash = match.group(1), match.group(2), match.group(3)
+        else:
+          file_hash, separator, f = line.partition('  ')
+          label = 'sha256'
+          if not separator:
+            continue
+        entry = expected.pop(f, None)
+        if entry is None or entry[0] == '':
+          ret['unknown'].append(f)
+        elif entry[0] != file_hash or entry[1].upper() != label.upper():
+          ret['mismatched'].append(f)
+    ret['unlisted'] = sorted(f for f, entry in expected.items() if entry[0] != '')
+    return ret
 
 
@@ -1,12 +1,39 @@
 #!/usr/bin/env python3
 
 from numpy import empty
-import rosbag
-import rospy
 import datetime
 import json
+import struct
 from pathlib import Path
 from file_info import FileInfo
+import track_store
+import bag_reader
+
+# rosbag is only needed to extract positions. Without it, the message counts and
+# times are still read from the bag index.
+try:
+  import rosbag
+except ImportError:
+  rosbag = None
+
+# Positions are decoded straight from the serialized messages. Every supported type
+# starts with a std_msgs/Header: uint32 seq, time stamp (uint32 secs, uint32 nsecs)
+# and a length prefixed frame_id string.
+header_struct = struct.Struct('<4I')
+# sensor_msgs/NavSatFix after the header: NavSatStatus (int8 status, uint16 service)
+# then float64 latitude, longitude and altitude.
+navsatfix_struct = struct.Struct('<bH3d')
+# geographic_msgs/GeoPoseStamped after the header: GeoPoint latitude, longitude, altitude.
+geopoint_struct = struct.Struct('<3d')
+
+def header_stamp(data):
+  # Returns the stamp in nanoseconds and the offset of the field after the header.
+  seq, secs, nsecs, frame_id_length = header_struct.unpack_from(data)
+  return secs*1000000000+nsecs, header_struct.size+frame_id_length
+
+def stamp_to_sec(stamp: int) -> float:
+  # Same conversion as rospy.Time.to_sec().
+  return float(stamp//1000000000)+float(stamp%1000000000)/1e9
 
 class RosBagHandler:
 
@@ -26,63 +53,83 @@ class RosBagHandler:
         
   position_topics = load_position_topics()
 
-  def get_msg_types(self,tt):
-    '''Returns a dictionary of of message topics (k) and types (v) found in a bag file.''' 
-    d = {}
-    for k,v in tt[1].items():
-      d[k]=v[0]
-    print(d)
-    return d
-
   def needsProcessing(self, file: FileInfo):
     if file.local_path.suffix == '.bag' and "mbes" not in file.local_path.parts:
       if file.has_meta_value(self, 'start_time') and not file.is_modified():
-        return False
-      if file.meta is not None and 'RosBagIndexHandler' in file.meta:
-        if 'indexed' in file.meta['RosBagIndexHandler'] and not file.meta['RosBagIndexHandler']['indexed']:
+        # Tracks are extracted only where rosbag is installed, so a bag summarized
+        # without it is processed again once rosbag is there. Metas from before the
+        # tracks_extracted flag count as extracted when they have tracks.
+        if file.has_meta_value(self, 'tracks_extracted') or file.has_meta_value(self, 'track_files') or file.has_meta_value(self, 'tracks'):
+          return False
+        if rosbag is None:
+          return False
+      if file.meta is not None and 'RosBagIndexHandler' in file.meta and 'indexed' in file.meta['RosBagIndexHandler']:
+        if not file.meta['RosBagIndexHandler']['indexed']:
           return False
+      else:
+        # Not checked by RosBagIndexHandler yet, so read the bag header.
+        try:
+          if bag_reader.probe_bag(file.source_path()) != bag_reader.INDEXED:
+            return False
+        except OSError:
+          pass
       if file.has_meta_value(self, 'message_count') and file.get_meta_value(self, 'message_count') == 0:
         return False
       return True
     return False
 
-  def process(self, file: FileInfo) -> FileInfo:
+  def access(self, file: FileInfo):
+    return 'random'
+
+  def process(self, file: FileInfo, source = None) -> FileInfo:
     try:
-      bag = rosbag.Bag(file.source_path())
+      info = bag_reader.read_bag_info(source if source is not None else file.source_path())
     except Exception as e:
       print("error opening bag file",file.local_path,e)
       print(type(e))
       return
+    if not info.indexed:
+      print("error opening bag file",file.local_path,"bag is not indexed")
+      return
+    file.update_meta_value(self, 'message_count', info.message_count())
+    if info.message_count() == 0:
+      return
+    file.update_meta_value(self, 'start_time', info.start_time())
+    file.update_meta_value(self, 'end_time', info.end_time())
+
+    # Get all the message types in this bag.
+    msg_types = info.topic_types()
+    topics = []
+    for t in RosBagHandler.position_topics:
+      if t in msg_types:
+        topics.append(t)
+    if len(topics) == 0:
+      file.update_meta_value(self, 'tracks_extracted', True)
+      return
+
+    if rosbag is None:
+      print("rosbag not available, skipping position extraction for",file.local_path)
+      return
     try:
-      file.update_meta_value(self, 'message_count', bag.get_message_count())
-      if bag.get_message_count() == 0:
-        return
-      file.update_meta_value(self, 'start_time', bag.get_start_time())
-      file.update_meta_value(self, 'end_time', bag.get_end_time())
-      tt = bag.get_type_and_topic_info()
-      topics = []
-      for t in RosBagHandler.position_topics:
-        if t in tt.topics:
-          topics.append(t)
-      
-      # Get all the message types in this bag.
-      msg_types = self.get_msg_types(tt)
-
-      if len(topics) == 0:
-        return
+      if source is not None:
+        source.seek(0)
+      bag = rosbag.Bag(source if source is not None else file.source_path())
     except Exception as e:
-      print("error getting times from bag file",file.local_path,e)
+      print("error opening bag file",file.local_path,e)
       print(type(e))
       return
 
     tracks = {}
     last_report_times = {}
-    interval = rospy.Duration(secs=1.0)
+    # Fixes are kept at least a second apart by header stamp, in nanoseconds. Messages
+    # are read raw; the stamp is decoded first so throttled messages are dropped before
+    # anything else is, and only the position fields are unpacked from those kept.
+    interval = 1000000000
     try:
 
-      for topic, msg, t in bag.read_messages(topics=topics):
+      for topic, raw, t in bag.read_messages(topics=topics, raw=True):
+        data, pytype = raw[1], raw[4]
         vehicle = RosBagHandler.position_topics[topic]
-        #print("Found vehicle %s in log %s" % (vehicle,file.source_path()))
         # Initialize a new track for this vehicle.
         if not vehicle in tracks:
           tracks[vehicle] = []
@@ -91,60 +138,42 @@ class RosBagHandler:
           # information is valid. This should be done by message type not by topic name, so the
           # topics are not hard coded here.
         if msg_types[topic] == 'mdt_msgs/Gps':
+          # No fixed layout is known for this one, so it is deserialized in full.
+          msg = pytype()
+          msg.deserialize(data)
           if msg.fix_quality > 0:
-            if last_report_times[vehicle] is None or msg.header.stamp - last_report_times[vehicle] >= interval:
-              fix = {'timestamp': msg.header.stamp.to_sec()}
-              fix['latitude'] = msg.latitude
-              fix['longitude'] = msg.longitude
-              fix['altitude'] = 0.0
-              tracks[vehicle].append(fix)
-              last_report_times[vehicle] = msg.header.stamp
-        #elif topic in ('/project11/mesobot/sensors/nav/pose','/project11/nui/nav/position'):
+            stamp = msg.header.stamp.to_nsec()
+            if last_report_times[vehicle] is None or stamp - last_report_times[vehicle] >= interval:
+              tracks[vehicle].append((msg.header.stamp.to_sec(), msg.latitude, msg.longitude, 0.0))
+              last_report_times[vehicle] = stamp
         elif msg_types[topic] == 'geographic_msgs/GeoPoseStamped':
-          if last_report_times[vehicle] is None or msg.header.stamp - last_report_times[vehicle] >= interval:
-              fix = {'timestamp': msg.header.stamp.to_sec()}
-              fix['latitude'] = msg.pose.position.latitude
-              fix['longitude'] = msg.pose.position.longitude
-              fix['altitude'] = msg.pose.position.altitude
-              tracks[vehicle].append(fix)
-              last_report_times[vehicle] = msg.header.stamp
-        # elif topic in ('/project11/nui/nav/position',):
-        #   if last_report_times[vehicle] is None or msg.header.stamp - last_report_times[vehicle] >= interval:
-        #       fix = {'timestamp': msg.header.stamp.to_sec()}
-        #       fix['latitude'] = msg.position.latitude
-        #       fix['longitude'] = msg.position.longitude
-        #       fix['altitude'] = msg.position.altitude
-        #       tracks[vehicle].append(fix)
-        #       last_report_times[vehicle] = msg.header.stamp
+          stamp, offset = header_stamp(data)
+          if last_report_times[vehicle] is None or stamp - last_report_times[vehicle] >= interval:
+            latitude, longitude, altitude = geopoint_struct.unpack_from(data, offset)
+            tracks[vehicle].append((stamp_to_sec(stamp), latitude, longitude, altitude))
+            last_report_times[vehicle] = stamp
         elif msg_types[topic] == 'sensor_msgs/NavSatFix':
-          if msg.status.status >= 0:
-            if last_report_times[vehicle] is None or msg.header.stamp - last_report_times[vehicle] >= interval:
-              fix = {'timestamp': msg.header.stamp.to_sec()}
-              fix['latitude'] = msg.latitude
-              fix['longitude'] = msg.longitude
-              fix['altitude'] = msg.altitude
-              tracks[vehicle].append(fix)
-              last_report_times[vehicle] = msg.header.stamp
+          stamp, offset = header_stamp(data)
+          if last_report_times[vehicle] is None or stamp - last_report_times[vehicle] >= interval:
+            status, service, latitude, longitude, altitude = navsatfix_struct.unpack_from(data, offset)
+            if status >= 0:
+              tracks[vehicle].append((stamp_to_sec(stamp), latitude, longitude, altitude))
+              last_report_times[vehicle] = stamp
 
     except Exception as e:
       print("error extracting nav from bag file",file.local_path, e)
 
+    # Fixes are (timestamp, latitude, longitude, altitude) tuples.
     bounds = {}
-    tracks_for_meta = {}
+    track_files = {}
     for v in tracks:
       if len(tracks[v]):
-        min_lat = tracks[v][0]['latitude']
-        max_lat = tracks[v][0]['latitude']
-        min_lon = tracks[v][0]['longitude']
-        max_lon = tracks[v][0]['longitude']
-        for fix in tracks[v]:
-          min_lat = min(min_lat, fix['latitude'])
-          max_lat = max(max_lat, fix['latitude'])
-          min_lon = min(min_lon, fix['longitude'])
-          max_lon = max(max_lon, fix['longitude'])
-        bounds[v] = {'min': {'latitude': min_lat, 'longitude': min_lon}, 'max': {'latitude': max_lat, 'longitude': max_lon}}
-        tracks_for_meta[v] = tracks[v]
+        track = track_store.to_array(tracks[v])
+        bounds[v] = track_store.bounds(track, altitude=False)
+        track_files[v] = track_store.save_track(file.project, file.local_path, v, track)
 
     if len(bounds):
       file.update_meta_value(self, 'bounds', bounds)
-      file.update_meta_value(self, 'tracks', tracks_for_meta)
+      file.update_meta_value(self, 'track_files', track_files)
+      file.remove_meta_value(self, 'tracks')
+    file.update_meta_value(self, 'tracks_extracted', True)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import rosbag
-import shutil
 import pathlib
 
 from file_info import FileInfo
+import bag_reader
+import bag_reindex
 
 class RosBagIndexHandler:
   def __init__(self):
@@ -18,30 +18,44 @@ class RosBagIndexHandler:
     
     if (file.local_path.suffix == '.bag' or 
     file.local_path.parts[-1].endswith('.bag.active')):
+      if not file.has_meta_value(self, 'indexed') or file.is_modified():
+        self.probe(file)
       if file.has_meta_value(self, 'indexed'):
         indexed = file.get_meta_value(self, 'indexed')
         if indexed:
           return False
         if file.has_meta_value(self, 'indexed_file'):
-          indexed_path = pathlib.Path(file.get_meta_value(self, 'indexed_file'))
-          if indexed_path in file.project.files:
-            indexed_file = file.project.files[indexed_path]
+          indexed_file = file.related_file(pathlib.Path(file.get_meta_value(self, 'indexed_file')))
+          if indexed_file is not None:
             if indexed_file.has_meta_value(self, 'indexed'):
               return not indexed_file.get_meta_value(self, 'indexed')
       return True
     return False
 
-  def process(self, file: FileInfo):
+  def probe(self, file: FileInfo):
+    # Whether the bag is indexed, unindexed or truncated, from its first few KB.
+    source_path = file.source_path()
+    if source_path is None:
+      return None
+    try:
+      state = bag_reader.probe_bag(source_path)
+    except OSError as e:
+      print("error opening bag to check if indexed", file.local_path, e)
+      return None
+    file.update_meta_value(self,'state',state)
+    file.update_meta_value(self,'indexed',state == bag_reader.INDEXED)
+    return state
+
+  def access(self, file: FileInfo):
+    return 'random'
+
+  def writes_output(self, file: FileInfo):
+    # The indexed copy goes to the project's output.
+    return True
+
+  def process(self, file: FileInfo, source = None):
     if self.needsProcessing(file):
-      try:
-        rosbag.Bag(file.source_path() , 'r')
-        file.update_meta_value(self,'indexed',True)
-      except rosbag.ROSBagUnindexedException:
-        file.update_meta_value(self,'indexed',False)
-      except Exception as e:
-        print("error opening bag to check if indexed", file.local_path)
-        print(type(e))
-        print(e)
+      if not file.has_meta_value(self,'indexed'):
         return file
 
       if not file.get_meta_value(self,'indexed'):
@@ -51,21 +65,22 @@ class RosBagIndexHandler:
           outfilename = file.project.output/outfilename
           if outfilename.is_file():
             try:
-              rosbag.Bag(outfilename, 'r')
-              file.update_meta_value(self,'indexed_file',str(local_outfn))
-              return file
-            except rosbag.ROSBagUnindexedException:
+              if bag_reader.probe_bag(outfilename) == bag_reader.INDEXED:
+                file.update_meta_value(self,'indexed_file',str(local_outfn))
+                return file
+            except Exception:
               pass
           outfilename.parent.mkdir(parents=True, exist_ok=True)
-          shutil.copy(str(file.source_path()), str(outfilename))
-          bag = rosbag.Bag(outfilename, 'a', allow_unindexed=True)
-          try:
-            for offset in bag.reindex():
-              pass
-          except:
-            pass
-          bag.close()
+          # The indexed copy is hashed as it is written.
+          indexed_hash = bag_reindex.reindex_bag(source if source is not None else file.source_path(), outfilename)
           file.update_meta_value(self,'indexed_file',str(local_outfn))
+          file.update_meta_value(self,'indexed_file_hash',indexed_hash)
+          # So HashHandler doesn't read the copy again, and it isn't probed.
+          stat = outfilename.stat()
+          file.add_output(local_outfn, {
+            'HashHandler': {'hash': indexed_hash, 'label': 'sha256'},
+            'RosBagIndexHandler': {'state': bag_reader.INDEXED, 'indexed': True},
+            'FileInfo': {'size': stat.st_size, 'modify_time': stat.st_mtime}})
         except Exception as e:
           print("error trying to index", file.local_path)
           print(type(e))
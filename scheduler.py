@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import collections
+import datetime
+from multiprocessing import Pool
+
+from typing import Callable, Dict, Iterator, List
+
+def timed_call(function, args):
+  start = time.perf_counter()
+  result = function(*args)
+  return os.getpid(), time.perf_counter()-start, result
+
+class WorkScheduler:
+  def __init__(self, process_count: int = 1, progress_interval = datetime.timedelta(seconds=0.5), initializer: Callable = None, initargs = (), group_limit: int = None, group_limits: Dict = None):
+    self.process_count = process_count
+    self.progress_interval = progress_interval
+    # Run once in each worker, or in this process when running inline.
+    self.initializer = initializer
+    self.initargs = initargs
+    # With task groups (the devices a file is read from and written to), at most
+    # group_limit tasks of a group run at once, or group_limits[group] for the groups
+    # given there.
+    self.group_limit = group_limit
+    self.group_limits = group_limits or {}
+    # Per worker pid: tasks completed, bytes handled and seconds spent working.
+    self.worker_stats = {}
+    # Per group, the same plus 'elapsed', the seconds from the start of the run to the
+    # group's last completed task, so size/elapsed is the group's throughput.
+    self.group_stats = {}
+    self.start_time = time.perf_counter()
+
+  def limit(self, group) -> int:
+    if group is None:
+      return None
+    return self.group_limits.get(group, self.group_limit)
+
+  def record(self, pid, seconds, size, groups = ()):
+    if not pid in self.worker_stats:
+      self.worker_stats[pid] = {'count': 0, 'size': 0, 'seconds': 0.0}
+    stats = self.worker_stats[pid]
+    stats['count'] += 1
+    stats['size'] += size
+    stats['seconds'] += seconds
+    for group in groups:
+      if group is None:
+        continue
+      if not group in self.group_stats:
+        self.group_stats[group] = {'count': 0, 'size': 0, 'seconds': 0.0, 'elapsed': 0.0}
+      stats = self.group_stats[group]
+      stats['count'] += 1
+      stats['size'] += size
+      stats['seconds'] += seconds
+      stats['elapsed'] = time.perf_counter()-self.start_time
+
+  def run(self, function: Callable, tasks: List, sizes: List = None, progress: Callable = None, groups: List = None) -> Iterator:
+    # Yields function(*task) for each task in completion order. With sizes, the largest
+    # tasks are started first so one big file doesn't end up running alone at the end.
+    # groups gives each task's group, or a tuple of groups when it uses several. With
+    # group limits, a task waits while any of its groups is at its limit and other
+    # tasks go ahead.
+    # progress() is called after each result and at least every progress_interval while
+    # waiting; returning True cancels the run and stops the workers.
+    if sizes is None:
+      sizes = [0]*len(tasks)
+    if groups is None:
+      groups = [()]*len(tasks)
+    groups = [tuple(dict.fromkeys(g)) if isinstance(g, tuple) else (g,) for g in groups]
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+    self.start_time = time.perf_counter()
+
+    if self.process_count <= 1:
+      if self.initializer is not None:
+        self.initializer(*self.initargs)
+      for i in order:
+        pid, seconds, result = timed_call(function, tasks[i])
+        self.record(pid, seconds, sizes[i], groups[i])
+        yield result
+        if progress is not None and progress():
+          return
+      return
+
+    # Tasks waiting to start, per combination of groups, largest first.
+    waiting = {}
+    for i in order:
+      if not groups[i] in waiting:
+        waiting[groups[i]] = collections.deque()
+      waiting[groups[i]].append(i)
+    running = {group: 0 for task_groups in waiting for group in task_groups}
+    limited = self.group_limit is not None or len(self.group_limits) > 0
+
+    def below_limit(task_groups) -> bool:
+      for group in task_groups:
+        limit = self.limit(group)
+        if limit is not None and running[group] >= limit:
+          return False
+      return True
+
+    def next_task():
+      # The largest waiting task whose groups are all below their limits.
+      best = None
+      for task_groups, indexes in waiting.items():
+        if indexes and (not limited or below_limit(task_groups)):
+          if best is None or sizes[indexes[0]] > sizes[best[0]]:
+            best = indexes
+      if best is None:
+        return None
+      return best.popleft()
+
+    # Results come back through apply_async callbacks. Only a couple of tasks per
+    # worker are kept in flight so arguments aren't all serialised up front. When
+    # groups are limited nothing is queued ahead, so in flight means running.
+    completed = queue.Queue()
+    max_in_flight = self.process_count if limited else self.process_count*2
+    pool = Pool(processes=self.process_count, initializer=self.initializer, initargs=self.initargs)
+    cancelled = True
+    try:
+      remaining = len(order)
+      in_flight = 0
+      timeout = self.progress_interval.total_seconds()
+      while remaining > 0:
+        while in_flight < max_in_flight:
+          i = next_task()
+          if i is None:
+            break
+          pool.apply_async(timed_call, (function, tasks[i]), callback=lambda r, size=sizes[i], task_groups=groups[i]: completed.put((r, size, task_groups, None)), error_callback=lambda e: completed.put((None, 0, None, e)))
+          for group in groups[i]:
+            running[group] += 1
+          in_flight += 1
+        try:
+          r, size, task_groups, error = completed.get(timeout=timeout)
+        except queue.Empty:
+          if progress is not None and progress():
+            return
+          continue
+        if error is not None:
+          raise error
+        in_flight -= 1
+        remaining -= 1
+        for group in task_groups:
+          running[group] -= 1
+        pid, seconds, result = r
+        self.record(pid, seconds, size, task_groups)
+        yield result
+        if progress is not None and progress():
+          return
+      cancelled = False
+    finally:
+      if cancelled:
+        pool.terminate()
+      else:
+        pool.close()
+      pool.join()
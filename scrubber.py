@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import hashlib
+
+from file_info import FileInfo
+from hash_handler import HashHandler, tree_chunk_size
+
+# Re-hashes archived files to catch bit rot. Each run works through the files that have
+# gone longest without verification, reading at most 'rate' MB/s, and stops before
+# starting a file once 'max_size' MB were read or 'max_time' minutes have passed. The
+# next run carries on from there. Settings come from the 'scrub' section of the project
+# config. Each file's meta gets the time it was last verified and the result:
+#   ok       - matches the recorded HashHandler hash
+#   mismatch - doesn't; the hash found is kept as 'found_hash'
+#   modified - size or modify time changed since it was hashed, so not comparable;
+#              counted but not recorded
+#   error    - couldn't be read
+default_settings = {
+  'rate': 50,
+  'max_size': None,
+  'max_time': 60,
+  'block_size': 1024*1024,
+}
+
+class Scrubber:
+  def __init__(self, project, rate: float = None, max_size: float = None, max_time: float = None):
+    self.project = project
+    self.settings = dict(default_settings)
+    if project.config is not None and 'scrub' in project.config:
+      self.settings.update(project.config['scrub'])
+    if rate is not None:
+      self.settings['rate'] = rate
+    if max_size is not None:
+      self.settings['max_size'] = max_size
+    if max_time is not None:
+      self.settings['max_time'] = max_time
+    self.read_size = 0
+    self.start_time = None
+
+  def last_verified(self, file: FileInfo) -> float:
+    if file.has_meta_value(self, 'last_verified'):
+      return file.get_meta_value(self, 'last_verified')
+    return 0.0
+
+  def candidates(self):
+    # Hashed files, oldest verification first. Only the meta is looked at here.
+    files = []
+    for file in self.project.files.values():
+      if file.file_exists is False or not file.has_meta_value(HashHandler(), 'hash'):
+        continue
+      files.append(file)
+    return sorted(files, key=self.last_verified)
+
+  def file_size(self, file: FileInfo) -> int:
+    if file.size is not None:
+      return file.size
+    if file.has_meta_value(file, 'size'):
+      return file.get_meta_value(file, 'size')
+    return 0
+
+  def throttle(self, size: int):
+    # Sleeps as needed to keep the average read rate since the start under the budget.
+    self.read_size += size
+    if self.settings['rate']:
+      ahead = self.read_size/(self.settings['rate']*1024*1024)-(time.monotonic()-self.start_time)
+      if ahead > 0:
+        time.sleep(ahead)
+
+  def hash(self, fd, chunk_size: int = None) -> str:
+    # Plain sha256, or with chunk_size the tree hash HashHandler records, computed
+    # sequentially instead of with parallel threads.
+    size = os.fstat(fd).st_size
+    root = hashlib.sha256()
+    hash = hashlib.sha256()
+    offset = 0
+    chunk_offset = 0
+    while offset < size:
+      read_size = self.settings['block_size']
+      if chunk_size is not None:
+        read_size = min(read_size, chunk_size-chunk_offset)
+      data = os.pread(fd, read_size, offset)
+      if not data:
+        break
+      hash.update(data)
+      offset += len(data)
+      chunk_offset += len(data)
+      self.throttle(len(data))
+      if chunk_size is not None and chunk_offset == chunk_size:
+        root.update(hash.digest())
+        hash = hashlib.sha256()
+        chunk_offset = 0
+    if chunk_size is None:
+      return hash.hexdigest()
+    if chunk_offset > 0:
+      root.update(hash.digest())
+    return root.hexdigest()
+
+  def verify(self, file: FileInfo) -> str:
+    hash_handler = HashHandler()
+    expected = file.get_meta_value(hash_handler, 'hash')
+    label = hash_handler.recorded_label(file)
+    # Fresh stat, the file may have changed since it was scanned.
+    if not file.update_from_source(True):
+      print('error verifying', file.local_path, 'file not found')
+      return 'error'
+    if file.is_modified():
+      return 'modified'
+    path = file.source_path()
+    try:
+      with open(path, 'rb') as source:
+        fd = source.fileno()
+        if hasattr(os, 'posix_fadvise'):
+          os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        found = self.hash(fd, tree_chunk_size(label))
+        # Don't push everything else out of the page cache.
+        if hasattr(os, 'posix_fadvise'):
+          os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (OSError, ValueError) as e:
+      print('error verifying', file.local_path, e)
+      return 'error'
+    if found != expected:
+      file.update_meta_value(self, 'found_hash', found)
+      return 'mismatch'
+    file.remove_meta_value(self, 'found_hash')
+    return 'ok'
+
+  def run(self, progress_callback = None):
+    # Returns the count of files per result. progress_callback(file, result, read_size)
+    # is called after each file.
+    self.start_time = time.monotonic()
+    self.read_size = 0
+    max_size = self.settings['max_size']
+    max_time = self.settings['max_time']
+    results = {}
+    with self.project.meta_store.batch():
+      for file in self.candidates():
+        if max_time is not None and time.monotonic()-self.start_time >= max_time*60:
+          break
+        if max_size is not None and self.read_size > 0 and self.read_size+self.file_size(file) > max_size*1024*1024:
+          break
+        result = self.verify(file)
+        results[result] = results.get(result, 0)+1
+        if result == 'modified':
+          # Saving the meta would record the new size and modify time and hide the
+          # change from HashHandler, so it's left for the next process run.
+          continue
+        file.update_meta_value(self, 'last_verified', time.time())
+        file.update_meta_value(self, 'result', result)
+        file.save_meta()
+        if progress_callback is not None:
+          progress_callback(file, result, self.read_size)
+    return results
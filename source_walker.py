@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import pathlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from odm_utils import atomic_write
+
+from typing import Dict, Iterator, List, Tuple
+
+# Size and modify time of a file as recorded by a previous scan.
+RecordedStat = namedtuple('RecordedStat', ['st_size', 'st_mtime'])
+
+# Directories modified this recently are not trusted on the next scan, since a file
+# added within the same mtime tick would not change the directory's mtime.
+settle_time = 2.0
+
+# A directory is reused only when its ctime is unchanged too. rsync -a puts directory
+# mtimes back after replacing files in them, but setting the mtime (or renaming a file
+# into the directory) updates the ctime, which can't be set back.
+
+def scan_directory(directory: pathlib.Path, snapshot: Dict = None) -> Tuple[List, List, Dict]:
+  try:
+    stat = os.stat(directory)
+  except OSError as e:
+    print('error scanning directory', directory, e)
+    return [], [], None
+
+  previous = None
+  if snapshot is not None:
+    previous = snapshot.get(str(directory))
+  mtime = stat.st_mtime
+  ctime = stat.st_ctime_ns
+  if previous is not None and previous['mtime'] == mtime and previous.get('ctime') == ctime:
+    files = [(directory/name, RecordedStat(*s)) for name, s in previous['files'].items()]
+    subdirectories = [directory/name for name in previous['dirs']]
+    return files, subdirectories, previous
+
+  files = []
+  subdirectories = []
+  try:
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        try:
+          # Like Path.glob('**'), don't descend into symlinked directories.
+          if entry.is_dir(follow_symlinks=False):
+            subdirectories.append(directory/entry.name)
+          elif entry.is_file():
+            files.append((directory/entry.name, entry.stat()))
+        except OSError as e:
+          print('error reading', directory/entry.name, e)
+  except OSError as e:
+    print('error scanning directory', directory, e)
+    return files, subdirectories, None
+
+  if stat.st_ctime > time.time() - settle_time:
+    mtime = None
+  record = {'mtime': mtime, 'ctime': ctime, 'files': {p.name: [s.st_size, s.st_mtime] for p, s in files}, 'dirs': [d.name for d in subdirectories]}
+  return files, subdirectories, record
+
+def walk_files(root: pathlib.Path, thread_count: int = 8, snapshot: Dict = None, new_snapshot: Dict = None) -> Iterator[Tuple[pathlib.Path, os.stat_result]]:
+  # Each directory is listed by a pool thread so that slow mounts (sshfs) have several
+  # listings in flight at once. The DirEntry stat is returned with the path so callers
+  # don't need to stat the file again.
+  # With a snapshot from a previous walk, a directory whose mtime and ctime haven't
+  # changed costs one stat: its files are returned with their recorded stats and its
+  # subdirectories come from the snapshot. Subdirectories are still visited since
+  # changes below a directory don't update its times.
+  with ThreadPoolExecutor(max_workers=thread_count) as executor:
+    directories = {executor.submit(scan_directory, root, snapshot): root}
+    pending = set(directories)
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        directory = directories.pop(future)
+        files, subdirectories, record = future.result()
+        if new_snapshot is not None and record is not None:
+          new_snapshot[str(directory)] = record
+        for subdirectory in subdirectories:
+          f = executor.submit(scan_directory, subdirectory, snapshot)
+          directories[f] = subdirectory
+          pending.add(f)
+        for f in files:
+          yield f
+
+def load_snapshot(path: pathlib.Path) -> Dict:
+  if path.is_file():
+    try:
+      with path.open() as infile:
+        return json.load(infile)
+    except json.decoder.JSONDecodeError as e:
+      print('error loading scan snapshot:', path, e)
+  return {}
+
+def save_snapshot(path: pathlib.Path, snapshot: Dict):
+  with atomic_write(path) as outfile:
+    json.dump(snapshot, outfile)
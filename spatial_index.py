@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import json
+import math
+
+from file_info import FileInfo
+from odm_utils import atomic_write
+
+from typing import Dict, Iterable, List
+
+# Index of where and when each bag saw each vehicle: a box of (latitude, longitude,
+# time) per bag and vehicle, from RosBagHandler's per vehicle bounds and the bag's
+# start and end times. The boxes are bulk loaded into an R-tree with
+# Sort-Tile-Recursive packing and saved, tree included, in the project's config
+# directory, so a query loads one file and visits only the nodes overlapping it.
+#
+# Boxes are [min latitude, min longitude, start time, max latitude, max longitude,
+# end time]. A node is a box followed by the position and count of its children in
+# the level below; level 0 nodes point into the items.
+#
+# Updates don't repack the tree. A changed or removed file's packed items are marked
+# removed, and new or changed boxes are added to a pending list that queries check one
+# by one. The tree is repacked once those make up more than 1/repack_fraction of it.
+
+node_capacity = 16
+repack_fraction = 8
+index_version = 2
+
+def file_boxes(file: FileInfo) -> Dict[str, List[float]]:
+  # vehicle: box, for a file with RosBagHandler bounds and times.
+  if file.meta is None or not 'RosBagHandler' in file.meta:
+    return {}
+  meta = file.meta['RosBagHandler']
+  if not 'bounds' in meta or not 'start_time' in meta or not 'end_time' in meta:
+    return {}
+  ret = {}
+  for vehicle, bounds in meta['bounds'].items():
+    if bounds is None:
+      continue
+    ret[vehicle] = [bounds['min']['latitude'], bounds['min']['longitude'], meta['start_time'], bounds['max']['latitude'], bounds['max']['longitude'], meta['end_time']]
+  return ret
+
+def center(box, axis: int) -> float:
+  return box[axis]+box[axis+3]
+
+def str_order(boxes: List[List[float]]) -> List[int]:
+  # Sort-Tile-Recursive: orders boxes so consecutive runs of node_capacity make
+  # compact nodes. Sorted into slabs by latitude, each slab into runs by longitude,
+  # each run by time.
+  if len(boxes) == 0:
+    return []
+  leaf_count = math.ceil(len(boxes)/node_capacity)
+  slices = math.ceil(leaf_count**(1/3))
+  slab_size = node_capacity*slices*slices
+  run_size = node_capacity*slices
+  order = sorted(range(len(boxes)), key=lambda i: center(boxes[i], 0))
+  ret = []
+  for slab_start in range(0, len(order), slab_size):
+    slab = sorted(order[slab_start:slab_start+slab_size], key=lambda i: center(boxes[i], 1))
+    for run_start in range(0, len(slab), run_size):
+      ret += sorted(slab[run_start:run_start+run_size], key=lambda i: center(boxes[i], 2))
+  return ret
+
+def enclosing(boxes: List[List[float]]) -> List[float]:
+  return [min(b[a] for b in boxes) for a in range(3)]+[max(b[a] for b in boxes) for a in range(3, 6)]
+
+def intersects(a, b) -> bool:
+  return a[0] <= b[3] and b[0] <= a[3] and a[1] <= b[4] and b[1] <= a[4] and a[2] <= b[5] and b[2] <= a[5]
+
+class SpatialIndex:
+  def __init__(self, project):
+    self.project = project
+    self.index_file = project.config_path/'spatial_index.json'
+    # local path: {vehicle: box}
+    self.entries = {}
+    # [local path, vehicle] and box of each item, in leaf order.
+    self.items = []
+    self.boxes = []
+    self.levels = []
+    # [local path, vehicle, box] added since the last pack, and positions in items of
+    # packed items removed since.
+    self.pending = []
+    self.removed = set()
+
+  def load(self) -> bool:
+    if not self.index_file.is_file():
+      return False
+    try:
+      with self.index_file.open() as infile:
+        data = json.load(infile)
+    except json.decoder.JSONDecodeError as e:
+      print('error loading spatial index:', self.index_file, e)
+      return False
+    if data.get('version') != index_version:
+      return False
+    self.entries = data['entries']
+    self.items = data['items']
+    self.boxes = data['boxes']
+    self.levels = data['levels']
+    self.pending = data['pending']
+    self.removed = set(data['removed'])
+    return True
+
+  def save(self):
+    with atomic_write(self.index_file) as outfile:
+      json.dump({'version': index_version, 'entries': self.entries, 'items': self.items, 'boxes': self.boxes, 'levels': self.levels, 'pending': self.pending, 'removed': sorted(self.removed)}, outfile)
+
+  def pack(self):
+    items = []
+    boxes = []
+    for local_path in sorted(self.entries):
+      for vehicle, box in sorted(self.entries[local_path].items()):
+        items.append([local_path, vehicle])
+        boxes.append(box)
+    order = str_order(boxes)
+    self.pending = []
+    self.removed = set()
+    self.items = [items[i] for i in order]
+    self.boxes = [boxes[i] for i in order]
+    self.levels = []
+    children = self.boxes
+    while len(children) > 0:
+      level = []
+      for first in range(0, len(children), node_capacity):
+        count = min(node_capacity, len(children)-first)
+        level.append(enclosing(children[first:first+count])+[first, count])
+      self.levels.append(level)
+      if len(level) == 1:
+        break
+      # Order this level's nodes for the next one up. Their children stay where they
+      # are, so only the nodes move.
+      order = str_order(level)
+      level[:] = [level[i] for i in order]
+      children = level
+
+  def build(self, files: Iterable[FileInfo]):
+    self.entries = {}
+    for file in files:
+      boxes = file_boxes(file)
+      if boxes:
+        self.entries[str(file.local_path)] = boxes
+    self.pack()
+    self.save()
+
+  def update(self, files: Iterable[FileInfo]) -> bool:
+    # Updates the entries of files whose boxes changed, saving only when one did.
+    slots = None
+    changed = False
+    for file in files:
+      local_path = str(file.local_path)
+      boxes = file_boxes(file)
+      if self.entries.get(local_path, {}) == boxes:
+        continue
+      if slots is None:
+        slots = self.slots()
+      self.remove(local_path, slots)
+      if boxes:
+        self.entries[local_path] = boxes
+        for vehicle, box in sorted(boxes.items()):
+          self.pending.append([local_path, vehicle, box])
+      changed = True
+    if not changed:
+      return False
+    if len(self.pending)+len(self.removed) > max(node_capacity, len(self.items)//repack_fraction):
+      self.pack()
+    self.save()
+    return True
+
+  def slots(self) -> Dict[str, List[int]]:
+    # local path: positions of its packed items.
+    ret = {}
+    for i, (local_path, vehicle) in enumerate(self.items):
+      if not local_path in ret:
+        ret[local_path] = []
+      ret[local_path].append(i)
+    return ret
+
+  def remove(self, local_path: str, slots: Dict[str, List[int]]):
+    if local_path in self.entries:
+      del self.entries[local_path]
+    self.pending = [p for p in self.pending if p[0] != local_path]
+    self.removed.update(slots.get(local_path, []))
+
+  def search(self, box: List[float]) -> List[List[str]]:
+    # [local path, vehicle] of the items overlapping box.
+    ret = [[local_path, vehicle] for local_path, vehicle, item_box in self.pending if intersects(item_box, box)]
+    if len(self.levels) == 0:
+      return ret
+    top = len(self.levels)-1
+    stack = [(top, i) for i in range(len(self.levels[top]))]
+    while stack:
+      level, i = stack.pop()
+      node = self.levels[level][i]
+      if not intersects(node, box):
+        continue
+      first, count = node[6], node[7]
+      if level == 0:
+        for j in range(first, first+count):
+          if intersects(self.boxes[j], box) and not j in self.removed:
+            ret.append(self.items[j])
+      else:
+        for j in range(first, first+count):
+          stack.append((level-1, j))
+    return ret
+
+  def query(self, bbox = None, start_time: float = None, end_time: float = None, vehicle: str = None) -> List[str]:
+    # Local paths of the bags that saw vehicle (or any vehicle) inside bbox, given as
+    # (min latitude, min longitude, max latitude, max longitude), between start_time
+    # and end_time (seconds since the epoch). Unset limits are open.
+    box = [-math.inf, -math.inf, -math.inf, math.inf, math.inf, math.inf]
+    if bbox is not None:
+      box[0], box[1], box[3], box[4] = bbox
+    if start_time is not None:
+      box[2] = start_time
+    if end_time is not None:
+      box[5] = end_time
+    ret = set()
+    for local_path, item_vehicle in self.search(box):
+      if vehicle is None or item_vehicle == vehicle:
+        ret.add(local_path)
+    return sorted(ret)
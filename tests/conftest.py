@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The modules live at the top of the repository.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
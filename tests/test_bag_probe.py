@@ -0,0 +1,58 @@
+import pathlib
+
+import bag_reader
+from project import Project
+from file_info import FileInfo
+from ros_bag_index_handler import RosBagIndexHandler
+from test_bag_reader import make_bag
+
+def test_probe_states(tmp_path):
+  path = tmp_path/'indexed.bag'
+  path.write_bytes(make_bag())
+  assert bag_reader.probe_bag(path) == bag_reader.INDEXED
+  path = tmp_path/'unindexed.bag'
+  path.write_bytes(make_bag(indexed=False))
+  assert bag_reader.probe_bag(path) == bag_reader.UNINDEXED
+  path = tmp_path/'truncated.bag'
+  data = make_bag()
+  path.write_bytes(data[:len(data)//2])
+  assert bag_reader.probe_bag(path) == bag_reader.TRUNCATED
+  path = tmp_path/'invalid.bag'
+  path.write_bytes(b'not a bag at all')
+  assert bag_reader.probe_bag(path) == bag_reader.INVALID
+
+def make_project(tmp_path) -> Project:
+  source = tmp_path/'src'
+  (source/'drix08').mkdir(parents=True)
+  (source/'drix08/VEHICLE_a.bag.active').write_bytes(make_bag(active=True))
+  project = Project(tmp_path/'cfg')
+  project.create(source)
+  project = Project(tmp_path/'cfg')
+  project.load()
+  project.scan_source()
+  return project
+
+def test_probe_missing_source(tmp_path):
+  project = make_project(tmp_path)
+  file = FileInfo(project, local_path=pathlib.Path('drix08/VEHICLE_b.bag'))
+  file.load_meta()
+  handler = RosBagIndexHandler()
+  assert handler.probe(file) is None
+  assert handler.needsProcessing(file)
+  assert not file.has_meta_value(handler, 'state')
+
+def test_reindex_from_open_source(tmp_path):
+  # The handler reindexes from the file it is given, here one whose path is gone.
+  project = make_project(tmp_path)
+  file = project.files[pathlib.Path('drix08/VEHICLE_a.bag.active')]
+  handler = RosBagIndexHandler()
+  assert handler.needsProcessing(file)
+  assert file.get_meta_value(handler, 'state') == bag_reader.UNINDEXED
+  source_path = file.source_path()
+  with open(source_path, 'rb') as source:
+    source_path.unlink()
+    handler.process(file, source)
+  output = project.output/'drix08/VEHICLE_a.bag.indexed.bag'
+  assert file.get_meta_value(handler, 'indexed_file') == 'drix08/VEHICLE_a.bag.indexed.bag'
+  assert bag_reader.probe_bag(output) == bag_reader.INDEXED
+  assert bag_reader.read_bag_info(output).message_count() == 30
@@ -0,0 +1,90 @@
+import struct
+
+import bag_reader
+
+# Small ROS bag v2.0 files written field by field: two connections, a few uncompressed
+# chunks, and optionally the index at the end.
+
+t0 = 1696118400
+connections = [(0, b'/gps', b'sensor_msgs/NavSatFix', b'2d3a8cd499b9b4a0249fb98fd05cfa48'), (1, b'/status', b'std_msgs/String', b'992ce8a1687cec8c8bd883ec73ca41d1')]
+
+def field(name, value):
+  f = name.encode()+b'='+value
+  return struct.pack('<I', len(f))+f
+
+def record(fields, data):
+  header = b''.join([field(name, value) for name, value in fields])
+  return struct.pack('<I', len(header))+header+struct.pack('<I', len(data))+data
+
+def stamp(secs, nsecs=0):
+  return struct.pack('<2I', secs, nsecs)
+
+def connection_record(connection):
+  conn, topic, msg_type, md5sum = connection
+  data = field('topic', topic)+field('type', msg_type)+field('md5sum', md5sum)+field('message_definition', b'')
+  return record([('op', b'\x07'), ('conn', struct.pack('<I', conn)), ('topic', topic)], data)
+
+def chunk_records(first_message, count):
+  # Connection records, then count messages a quarter second apart, alternating
+  # between the connections.
+  data = b''.join([connection_record(c) for c in connections])
+  entries = {}
+  times = []
+  for i in range(first_message, first_message+count):
+    conn = i % 2
+    secs, nsecs = t0+i//4, (i % 4)*250000000
+    time = stamp(secs, nsecs)
+    entries.setdefault(conn, []).append((time, len(data)))
+    times.append((secs, nsecs))
+    data += record([('op', b'\x02'), ('conn', struct.pack('<I', conn)), ('time', time)], struct.pack('<I', 4)+b'msg'+bytes([i % 256]))
+  return data, entries, stamp(*min(times)), stamp(*max(times))
+
+def make_bag(chunk_count=3, per_chunk=10, indexed=True, active=False):
+  # With active, the last chunk is left as rosbag leaves one being written: sizes of
+  # zero and its records running to the end of the file.
+  body = b''
+  infos = []
+  header_length = 4+200+4
+  position = len(bag_reader.magic)+header_length
+  for c in range(chunk_count):
+    data, entries, start, end = chunk_records(c*per_chunk, per_chunk)
+    if active and c == chunk_count-1:
+      chunk = record([('op', b'\x05'), ('compression', b'none'), ('size', struct.pack('<I', 0))], b'')+data
+      body += chunk
+      break
+    chunk = record([('op', b'\x05'), ('compression', b'none'), ('size', struct.pack('<I', len(data)))], data)
+    for conn, conn_entries in entries.items():
+      chunk += record([('op', b'\x04'), ('ver', struct.pack('<I', 1)), ('conn', struct.pack('<I', conn)), ('count', struct.pack('<I', len(conn_entries)))], b''.join([time+struct.pack('<I', offset) for time, offset in conn_entries]))
+    infos.append((position, start, end, {conn: len(e) for conn, e in entries.items()}))
+    body += chunk
+    position += len(chunk)
+  index_pos = position
+  index = b''
+  if indexed and not active:
+    index = b''.join([connection_record(c) for c in connections])
+    for chunk_pos, start, end, counts in infos:
+      index += record([('op', b'\x06'), ('ver', struct.pack('<I', 1)), ('chunk_pos', struct.pack('<Q', chunk_pos)), ('start_time', start), ('end_time', end), ('count', struct.pack('<I', len(counts)))], b''.join([struct.pack('<2I', conn, n) for conn, n in counts.items()]))
+  else:
+    index_pos = 0
+  fields = field('op', b'\x03')+field('index_pos', struct.pack('<Q', index_pos))+field('conn_count', struct.pack('<I', len(connections) if index_pos else 0))+field('chunk_count', struct.pack('<I', len(infos) if index_pos else 0))
+  padding = header_length-8-len(fields)
+  header = struct.pack('<I', len(fields))+fields+struct.pack('<I', padding)+b' '*padding
+  return bag_reader.magic+header+body+index
+
+def check_info(info, message_count):
+  assert info.indexed
+  assert info.message_count() == message_count
+  assert info.start_time() == t0
+  last = message_count-1
+  assert info.end_time() == t0+last//4+(last % 4)*0.25
+  assert info.topic_types() == {'/gps': 'sensor_msgs/NavSatFix', '/status': 'std_msgs/String'}
+
+def test_read_indexed_bag(tmp_path):
+  path = tmp_path/'indexed.bag'
+  path.write_bytes(make_bag())
+  check_info(bag_reader.read_bag_info(path), 30)
+
+def test_read_unindexed_bag(tmp_path):
+  path = tmp_path/'unindexed.bag'
+  path.write_bytes(make_bag(indexed=False))
+  assert not bag_reader.read_bag_info(path).indexed
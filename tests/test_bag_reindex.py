@@ -0,0 +1,54 @@
+import hashlib
+import pathlib
+
+import bag_reader
+import bag_reindex
+from project import Project
+from hash_handler import HashHandler
+from ros_bag_index_handler import RosBagIndexHandler
+from test_bag_reader import make_bag, check_info
+
+def test_reindex_round_trip(tmp_path):
+  source = tmp_path/'unindexed.bag'
+  source.write_bytes(make_bag(indexed=False))
+  output = tmp_path/'unindexed.indexed.bag'
+  digest = bag_reindex.reindex_bag(source, output)
+  assert digest == hashlib.sha256(output.read_bytes()).hexdigest()
+  assert bag_reader.probe_bag(output) == bag_reader.INDEXED
+  info = bag_reader.read_bag_info(output)
+  check_info(info, 30)
+  # Same summary as the bag written with its index.
+  expected_path = tmp_path/'indexed.bag'
+  expected_path.write_bytes(make_bag())
+  expected = bag_reader.read_bag_info(expected_path)
+  assert [(c['start_time'], c['end_time'], c['counts']) for c in info.chunks] == [(c['start_time'], c['end_time'], c['counts']) for c in expected.chunks]
+  assert info.connections == expected.connections
+
+def test_reindex_active_bag(tmp_path):
+  source = tmp_path/'active.bag'
+  source.write_bytes(make_bag(active=True))
+  output = tmp_path/'active.indexed.bag'
+  bag_reindex.reindex_bag(source, output)
+  check_info(bag_reader.read_bag_info(output), 30)
+  # Reindexing an indexed bag gives it back unchanged.
+  again = tmp_path/'again.bag'
+  bag_reindex.reindex_bag(output, again)
+  assert again.read_bytes() == output.read_bytes()
+
+def test_reindexed_copy_meta(tmp_path):
+  # Processing records the indexed copy with its hash, so it isn't read again.
+  source = tmp_path/'src'
+  (source/'drix08').mkdir(parents=True)
+  (source/'drix08/VEHICLE_a.bag.active').write_bytes(make_bag(active=True))
+  project = Project(tmp_path/'cfg')
+  project.create(source)
+  project = Project(tmp_path/'cfg')
+  project.load()
+  project.scan_source()
+  project.scan([RosBagIndexHandler])
+  project.process([RosBagIndexHandler])
+  output = project.output/'drix08/VEHICLE_a.bag.indexed.bag'
+  copy = project.files[pathlib.Path('drix08/VEHICLE_a.bag.indexed.bag')]
+  assert copy.meta['HashHandler']['hash'] == hashlib.sha256(output.read_bytes()).hexdigest()
+  assert copy.meta['RosBagIndexHandler']['indexed']
+  assert not HashHandler().needsProcessing(copy)
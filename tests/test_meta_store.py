@@ -0,0 +1,42 @@
+import pathlib
+import sqlite3
+import time
+
+from meta_store import SqliteMetaStore
+
+def saved_paths(db_path):
+  # What another process sees.
+  connection = sqlite3.connect(str(db_path))
+  try:
+    return sorted(row[0] for row in connection.execute('SELECT DISTINCT local_path FROM meta'))
+  finally:
+    connection.close()
+
+def test_batch_commits_every_batch_size(tmp_path):
+  store = SqliteMetaStore(tmp_path/'meta.sqlite', batch_size=3, commit_interval=60)
+  with store.batch():
+    for i in range(4):
+      store.save(pathlib.Path('f%d' % i), {'HashHandler': {'hash': str(i)}})
+    assert saved_paths(store.db_path) == ['f0', 'f1', 'f2']
+  assert saved_paths(store.db_path) == ['f0', 'f1', 'f2', 'f3']
+
+def test_batch_commits_every_interval(tmp_path):
+  store = SqliteMetaStore(tmp_path/'meta.sqlite', batch_size=1000, commit_interval=0.1)
+  with store.batch():
+    store.save(pathlib.Path('f0'), {'HashHandler': {'hash': '0'}})
+    store.flush()
+    assert saved_paths(store.db_path) == []
+    time.sleep(0.2)
+    store.flush()
+    assert saved_paths(store.db_path) == ['f0']
+
+def test_batch_keeps_saved_rows_on_error(tmp_path):
+  store = SqliteMetaStore(tmp_path/'meta.sqlite', commit_interval=60)
+  try:
+    with store.batch():
+      store.save(pathlib.Path('f0'), {'HashHandler': {'hash': '0'}})
+      raise KeyboardInterrupt()
+  except KeyboardInterrupt:
+    pass
+  assert saved_paths(store.db_path) == ['f0']
+  assert store.load(pathlib.Path('f0')) == {'HashHandler': {'hash': '0'}}
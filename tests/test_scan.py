@@ -0,0 +1,43 @@
+import pathlib
+
+from project import Project
+from hash_handler import HashHandler
+from ros_bag_index_handler import RosBagIndexHandler
+from ros_bag_handler import RosBagHandler
+
+handlers = [HashHandler, RosBagIndexHandler, RosBagHandler]
+
+def make_project(root: pathlib.Path) -> Project:
+  # An active bag that was already reindexed, its indexed copy next to it, and a
+  # plain file.
+  source = root/'src'
+  (source/'drix08/02-raw').mkdir(parents=True)
+  (source/'drix08/02-raw/VEHICLE_a.bag.active').write_bytes(b'not indexed')
+  (source/'drix08/02-raw/VEHICLE_a.bag.indexed.bag').write_bytes(b'indexed copy')
+  (source/'drix08/02-raw/notes.txt').write_bytes(b'notes')
+  project = Project(root/'cfg')
+  project.create(source)
+  project = Project(root/'cfg')
+  project.load()
+  project.scan_source()
+  active = project.files[pathlib.Path('drix08/02-raw/VEHICLE_a.bag.active')]
+  active.update_meta_value(RosBagIndexHandler(), 'indexed_file', 'drix08/02-raw/VEHICLE_a.bag.indexed.bag')
+  active.save_meta()
+  copy = project.files[pathlib.Path('drix08/02-raw/VEHICLE_a.bag.indexed.bag')]
+  copy.update_meta_value(RosBagIndexHandler(), 'indexed', True)
+  copy.save_meta()
+  return project
+
+def scan(root: pathlib.Path, process_count: int):
+  project = Project(root/'cfg')
+  project.load()
+  project.scan_source()
+  project.scan(handlers, process_count)
+  return {str(local_path): f.pending_processors for local_path, f in project.files.items()}
+
+def test_parallel_scan_matches_serial(tmp_path):
+  make_project(tmp_path)
+  serial = scan(tmp_path, 1)
+  parallel = scan(tmp_path, 2)
+  assert parallel == serial
+  assert not 'RosBagIndexHandler' in serial['drix08/02-raw/VEHICLE_a.bag.active']
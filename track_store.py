@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import heapq
+import pathlib
+
+import numpy as np
+
+from file_info import FileInfo
+from odm_utils import atomic_write
+
+from typing import Dict, Iterator, List, Tuple
+
+# Tracks extracted from bags are kept out of the meta, in one file per bag and vehicle
+# under the project's tracks directory. A track is a (4, n) float64 array whose rows
+# are the timestamp, latitude, longitude and altitude columns, each contiguous in
+# memory. Plain .npy files are memory mapped when read; .npz files are compressed
+# and are read whole. The meta keeps a reference {'file': ..., 'count': ...} per vehicle
+# under RosBagHandler's 'track_files' key.
+
+TIMESTAMP = 0
+LATITUDE = 1
+LONGITUDE = 2
+ALTITUDE = 3
+
+def tracks_path(project) -> pathlib.Path:
+  return project.config_path/'tracks'
+
+def compress_tracks(project) -> bool:
+  if project.config is not None and 'tracks' in project.config:
+    return project.config['tracks'].get('compress', False)
+  return False
+
+def track_file(local_path: pathlib.Path, vehicle: str, compressed: bool) -> pathlib.Path:
+  return local_path.parent/(local_path.name+'.'+vehicle+('.npz' if compressed else '.npy'))
+
+def to_array(fixes) -> np.ndarray:
+  # fixes is a sequence of (timestamp, latitude, longitude, altitude) tuples.
+  if len(fixes) == 0:
+    return np.empty((4, 0))
+  return np.ascontiguousarray(np.array(fixes, dtype=np.float64).T)
+
+def save_track(project, local_path: pathlib.Path, vehicle: str, track: np.ndarray) -> Dict:
+  compressed = compress_tracks(project)
+  relative = track_file(local_path, vehicle, compressed)
+  path = tracks_path(project)/relative
+  with atomic_write(path, 'wb') as outfile:
+    if compressed:
+      np.savez_compressed(outfile, track=track)
+    else:
+      np.save(outfile, track)
+  return {'file': str(relative), 'count': int(track.shape[1])}
+
+def load_track(project, reference: Dict) -> np.ndarray:
+  path = tracks_path(project)/reference['file']
+  if path.suffix == '.npz':
+    with np.load(path) as data:
+      return data['track']
+  return np.load(path, mmap_mode='r')
+
+def legacy_track(fixes) -> np.ndarray:
+  return to_array([(f['timestamp'], f['latitude'], f['longitude'], f['altitude']) for f in fixes])
+
+def track_meta(file: FileInfo) -> Dict:
+  # The part of a file's RosBagHandler meta needed to load its tracks.
+  if file.meta is None or not 'RosBagHandler' in file.meta:
+    return {}
+  meta = file.meta['RosBagHandler']
+  if 'track_files' in meta:
+    return {'track_files': meta['track_files']}
+  if 'tracks' in meta:
+    return {'tracks': meta['tracks']}
+  return {}
+
+def load_meta_tracks(project, meta: Dict) -> Dict[str, np.ndarray]:
+  # Also reads the lists of fix dictionaries older meta kept under 'tracks'.
+  ret = {}
+  if 'track_files' in meta:
+    for vehicle, reference in meta['track_files'].items():
+      try:
+        ret[vehicle] = load_track(project, reference)
+      except (OSError, ValueError) as e:
+        print('error loading track', reference['file'], e)
+  elif 'tracks' in meta:
+    for vehicle, fixes in meta['tracks'].items():
+      ret[vehicle] = legacy_track(fixes)
+  return ret
+
+def externalize_tracks(file: FileInfo) -> bool:
+  # Moves a legacy 'tracks' list out of the meta into track files.
+  if file.meta is None or not 'RosBagHandler' in file.meta:
+    return False
+  meta = file.meta['RosBagHandler']
+  if not 'tracks' in meta:
+    return False
+  track_files = {}
+  for vehicle, fixes in meta['tracks'].items():
+    track_files[vehicle] = save_track(file.project, file.local_path, vehicle, legacy_track(fixes))
+  meta['track_files'] = track_files
+  del meta['tracks']
+  file.meta_updated = True
+  return True
+
+def externalize_project_tracks(project, progress_callback = None) -> int:
+  count = 0
+  with project.meta_store.batch():
+    for file in project():
+      if externalize_tracks(file):
+        file.save_meta()
+        count += 1
+        if progress_callback is not None:
+          progress_callback(count)
+  return count
+
+# Array operations shared by RosBagHandler and DrixDeployments.
+
+def is_sorted(track: np.ndarray) -> bool:
+  timestamps = track[TIMESTAMP]
+  return timestamps.shape[0] < 2 or bool(np.all(np.diff(timestamps) >= 0))
+
+def clip(track: np.ndarray, start_time: float, end_time: float) -> np.ndarray:
+  # Sorted tracks are sliced, so a memory mapped one stays a view of its file.
+  timestamps = track[TIMESTAMP]
+  if is_sorted(track):
+    first = int(np.searchsorted(timestamps, start_time, side='left'))
+    last = int(np.searchsorted(timestamps, end_time, side='right'))
+    return track[:, first:last]
+  return track[:, (timestamps >= start_time) & (timestamps <= end_time)]
+
+def decimate_indexes(timestamps: np.ndarray, interval: float, last_time: float = None) -> List[int]:
+  # Keeps a fix when it is at least interval after the last kept fix, at last_time
+  # when one was kept before these, like the per-message throttle. Sorted timestamps
+  # only take one searchsorted step per kept fix.
+  count = timestamps.shape[0]
+  if count == 0:
+    return []
+  if count < 2 or np.all(np.diff(timestamps) >= 0):
+    keep = []
+    i = 0
+    if last_time is not None:
+      i = int(np.searchsorted(timestamps, last_time+interval, side='left'))
+    while i < count:
+      keep.append(i)
+      i = int(np.searchsorted(timestamps, timestamps[i]+interval, side='left'))
+    return keep
+  keep = []
+  for i, timestamp in enumerate(timestamps.tolist()):
+    if last_time is None or timestamp >= last_time+interval:
+      keep.append(i)
+      last_time = timestamp
+  return keep
+
+def decimate(track: np.ndarray, interval: float = 1.0) -> np.ndarray:
+  # Tracks that are already sparse enough are returned as is.
+  timestamps = track[TIMESTAMP]
+  if timestamps.shape[0] < 2 or np.all(np.diff(timestamps) >= interval):
+    return track
+  return track[:, decimate_indexes(timestamps, interval)]
+
+def decimated_blocks(track: np.ndarray, interval: float = 1.0, block_size: int = 4096) -> Iterator[np.ndarray]:
+  # decimate(track) a block at a time, so a memory mapped track is not read in whole.
+  last_time = None
+  for start in range(0, track.shape[1], block_size):
+    block = track[:, start:start+block_size]
+    timestamps = block[TIMESTAMP]
+    if (last_time is None or timestamps[0] >= last_time+interval) and np.all(np.diff(timestamps) >= interval):
+      # Already sparse enough.
+      last_time = float(timestamps[-1])
+      yield block
+      continue
+    keep = decimate_indexes(timestamps, interval, last_time)
+    if len(keep):
+      last_time = float(block[TIMESTAMP][keep[-1]])
+      yield block[:, keep]
+
+def bounds(track: np.ndarray, altitude: bool = True) -> Dict:
+  if track.shape[1] == 0:
+    return None
+  mins = track.min(axis=1)
+  maxs = track.max(axis=1)
+  ret = {'min': {'latitude': float(mins[LATITUDE]), 'longitude': float(mins[LONGITUDE])}, 'max': {'latitude': float(maxs[LATITUDE]), 'longitude': float(maxs[LONGITUDE])}}
+  if altitude:
+    ret['min']['altitude'] = float(mins[ALTITUDE])
+    ret['max']['altitude'] = float(maxs[ALTITUDE])
+  return ret
+
+def merge_bounds(a: Dict, b: Dict) -> Dict:
+  if a is None:
+    return b
+  if b is None:
+    return a
+  return {'min': {k: min(a['min'][k], b['min'][k]) for k in a['min']}, 'max': {k: max(a['max'][k], b['max'][k]) for k in a['max']}}
+
+def sort_by_time(track: np.ndarray) -> np.ndarray:
+  timestamps = track[TIMESTAMP]
+  if timestamps.shape[0] < 2 or np.all(np.diff(timestamps) >= 0):
+    return track
+  return track[:, np.argsort(timestamps, kind='stable')]
+
+def iterate_fixes(track: np.ndarray, interval: float = None, block_size: int = 4096) -> Iterator[Tuple[float, float, float, float]]:
+  # Fixes in time order as (timestamp, latitude, longitude, altitude) tuples of floats,
+  # decimated to interval when given. Sorted tracks are converted a block at a time so
+  # memory mapped ones are not read in whole; others are decimated then sorted first.
+  if is_sorted(track):
+    if interval is not None:
+      blocks = decimated_blocks(track, interval, block_size)
+    else:
+      blocks = (track[:, start:start+block_size] for start in range(0, track.shape[1], block_size))
+  else:
+    if interval is not None:
+      track = decimate(track, interval)
+    track = sort_by_time(track)
+    blocks = (track[:, start:start+block_size] for start in range(0, track.shape[1], block_size))
+  for block in blocks:
+    for fix in block.T.tolist():
+      yield tuple(fix)
+
+def merge_tracks(tracks: List[np.ndarray], interval: float = None) -> Iterator[Tuple[float, float, float, float]]:
+  # Merges tracks into one time ordered stream of fixes, each decimated to interval
+  # when given, dropping exact duplicates (the same topic logged by both the vehicle
+  # and the operator station). Only a block of each track is in memory at a time.
+  last = None
+  for fix in heapq.merge(*[iterate_fixes(t, interval) for t in tracks]):
+    if fix != last:
+      yield fix
+      last = fix
+
+def fix_blocks(fixes: Iterator[Tuple[float, float, float, float]], block_size: int = 4096) -> Iterator[np.ndarray]:
+  # Groups a stream of fixes into track arrays of at most block_size fixes.
+  block = []
+  for fix in fixes:
+    block.append(fix)
+    if len(block) == block_size:
+      yield to_array(block)
+      block = []
+  if len(block):
+    yield to_array(block)
+
+def simplify(track: np.ndarray, tolerance: float) -> np.ndarray:
+  # Douglas-Peucker line simplification, keeping fixes that are more than tolerance
+  # meters from the line through the fixes kept around them. Positions are projected
+  # onto a local equirectangular plane, which is fine at deployment scales.
+  count = track.shape[1]
+  if tolerance <= 0 or count < 3:
+    return track
+  latitude = track[LATITUDE]
+  scale = np.cos(np.radians(np.mean(latitude)))
+  x = track[LONGITUDE]*111320.0*scale
+  y = latitude*110540.0
+  keep = np.zeros(count, dtype=bool)
+  keep[0] = True
+  keep[-1] = True
+  stack = [(0, count-1)]
+  while stack:
+    first, last = stack.pop()
+    if last-first < 2:
+      continue
+    dx = x[last]-x[first]
+    dy = y[last]-y[first]
+    px = x[first+1:last]-x[first]
+    py = y[first+1:last]-y[first]
+    length = np.hypot(dx, dy)
+    if length > 0:
+      distances = np.abs(px*dy-py*dx)/length
+    else:
+      distances = np.hypot(px, py)
+    i = int(np.argmax(distances))
+    if distances[i] > tolerance:
+      split = first+1+i
+      keep[split] = True
+      stack.append((first, split))
+      stack.append((split, last))
+  return track[:, keep]
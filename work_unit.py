@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import copy
+import pathlib
+
+from file_info import FileInfo
+
+# What is sent to and returned from worker processes. A FileInfo references its
+# Project and so the whole file table; these carry only the one file's state so the
+# cost of a task doesn't grow with the project.
+
+class WorkUnit:
+  def __init__(self, file: FileInfo):
+    self.local_path = file.local_path
+    self.source_file = file.source_path()
+    self.size = file.size
+    self.modify_time = file.modify_time
+    self.meta = file.meta
+    self.meta_exists = file.meta_exists
+    self.pending_processors = list(file.pending_processors)
+    # Meta of the files handlers look at besides this one: a bag's indexed copy.
+    self.related = {}
+    if file.meta is not None and 'indexed_file' in file.meta.get('RosBagIndexHandler', {}):
+      indexed_path = pathlib.Path(file.meta['RosBagIndexHandler']['indexed_file'])
+      indexed_file = file.project.get_fileinfo(indexed_path)
+      if indexed_file is not None and indexed_file.meta is not None:
+        self.related[indexed_path] = indexed_file.meta
+
+  def file_info(self, project) -> FileInfo:
+    # Handlers work on a copy so the unit's meta stays the baseline for the delta.
+    file = FileInfo(project, local_path=self.local_path)
+    file.meta = copy.deepcopy(self.meta) if self.meta is not None else {}
+    file.meta_exists = self.meta_exists
+    file.pending_processors = list(self.pending_processors)
+    for local_path, meta in self.related.items():
+      related = FileInfo(project, local_path=local_path)
+      related.set_meta(meta)
+      file.related[local_path] = related
+    if self.source_file is not None:
+      file.source_file = pathlib.Path(self.source_file)
+      file.size = self.size
+      file.modify_time = self.modify_time
+      file.file_exists = True
+    return file
+
+
+class ResultDelta:
+  def __init__(self, unit: WorkUnit, file: FileInfo):
+    self.local_path = unit.local_path
+    self.pending_processors = list(file.pending_processors)
+    self.outputs = list(file.outputs)
+    self.changes = {}
+    self.removed = {}
+    original = unit.meta or {}
+    for handler_label, values in (file.meta or {}).items():
+      before = original.get(handler_label, {})
+      changed = {k: v for k, v in values.items() if not k in before or before[k] != v}
+      if len(changed):
+        self.changes[handler_label] = changed
+      removed = [k for k in before if not k in values]
+      if len(removed):
+        self.removed[handler_label] = removed
+
+  def apply(self, file: FileInfo) -> FileInfo:
+    if file.meta is None:
+      file.load_meta()
+    for handler_label, values in self.changes.items():
+      if not handler_label in file.meta:
+        file.meta[handler_label] = {}
+      file.meta[handler_label].update(values)
+      file.meta_updated = True
+    for handler_label, keys in self.removed.items():
+      for k in keys:
+        file.meta.get(handler_label, {}).pop(k, None)
+      file.meta_updated = True
+    file.pending_processors = list(self.pending_processors)
+    file.state_changed()
+    return file